@@ -0,0 +1,72 @@
+import asyncio
+from logging.config import fileConfig
+
+from alembic import context
+from sqlalchemy import func, select
+from sqlalchemy.engine import Connection
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+
+from app.config import DATABASE_URL
+from app.db_models import Base
+
+config = context.config
+if config.config_file_name and config.attributes.get("configure_logger", True):
+    fileConfig(config.config_file_name, disable_existing_loggers=False)
+
+target_metadata = Base.metadata
+
+# Ключ advisory lock: миграции, запущенные одновременно несколькими
+# контейнерами, выполняются по очереди, следующие видят схему
+# уже обновленной
+MIGRATION_LOCK_KEY = 0x74776974
+MIGRATION_LOCK_POLL = 1
+
+
+def database_url() -> str:
+    """Адрес БД: sqlalchemy.url (задается в тестах) или DATABASE_URL"""
+    return config.get_main_option("sqlalchemy.url") or DATABASE_URL
+
+
+def run_migrations_offline() -> None:
+    """Выводит SQL миграций без подключения к БД (--sql)"""
+    context.configure(
+        url=database_url(),
+        target_metadata=target_metadata,
+        literal_binds=True,
+        dialect_opts={"paramstyle": "named"},
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def do_run_migrations(connection: Connection) -> None:
+    context.configure(connection=connection, target_metadata=target_metadata)
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+async def run_migrations_online() -> None:
+    engine = create_async_engine(database_url(), poolclass=NullPool)
+    # блокировка берется отдельным соединением вне транзакции и без
+    # ожидания внутри запроса: CREATE INDEX CONCURRENTLY ждет завершения
+    # чужих запросов и иначе попал бы во взаимную блокировку с ожидающими
+    async with engine.connect() as lock:
+        await lock.execution_options(isolation_level="AUTOCOMMIT")
+        lock_query = select(func.pg_try_advisory_lock(MIGRATION_LOCK_KEY))
+        while not await lock.scalar(lock_query):
+            await asyncio.sleep(MIGRATION_LOCK_POLL)
+        try:
+            async with engine.connect() as connection:
+                await connection.run_sync(do_run_migrations)
+        finally:
+            await lock.execute(
+                select(func.pg_advisory_unlock(MIGRATION_LOCK_KEY))
+            )
+    await engine.dispose()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    asyncio.run(run_migrations_online())
@@ -0,0 +1,50 @@
+"""Исходная схема: подписки и лайки хранятся в массивах JSON
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-17
+
+Таблицы создаются, только если их еще нет: БД, созданные до появления
+миграций (Base.metadata.create_all при старте), проходят эту ревизию
+без изменений.
+"""
+
+from alembic import op
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute(
+        "CREATE TABLE IF NOT EXISTS users ("
+        "id SERIAL NOT NULL, "
+        "name VARCHAR NOT NULL, "
+        "followers JSON[] NOT NULL, "
+        "following JSON[] NOT NULL, "
+        "PRIMARY KEY (id))"
+    )
+    op.execute(
+        "CREATE TABLE IF NOT EXISTS tweets ("
+        "id SERIAL NOT NULL, "
+        "tweet_data VARCHAR NOT NULL, "
+        "tweet_media_ids INTEGER[] NOT NULL, "
+        "user_id INTEGER NOT NULL, "
+        "likes JSONB[] NOT NULL, "
+        "PRIMARY KEY (id), "
+        "FOREIGN KEY (user_id) REFERENCES users (id))"
+    )
+    op.execute(
+        "CREATE TABLE IF NOT EXISTS medias ("
+        "id SERIAL NOT NULL, "
+        "filename VARCHAR NOT NULL, "
+        "PRIMARY KEY (id))"
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("medias")
+    op.drop_table("tweets")
+    op.drop_table("users")
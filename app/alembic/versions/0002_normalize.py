@@ -0,0 +1,246 @@
+"""Таблицы likes, follows, timelines, media_variants и счетчики
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17
+
+Лайки и подписки переносятся из массивов в таблицы, добавляются
+счетчики like_count и followers_count, уникальный индекс users.name
+и поля дедупликации изображений. Шаги проверяют текущее состояние схемы,
+поэтому ревизия применяется и к БД, уже обновленным прежними
+миграциями при старте приложения.
+
+Пользователи с одинаковыми именами (Api-Key) перед созданием индекса
+объединяются в пользователя с меньшим id: прежняя версия по Api-Key
+находила первого из них. Откат возвращает массивы лайков и подписок,
+объединенные пользователи не восстанавливаются.
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def column_exists(table: str, column: str) -> bool:
+    columns = sa.inspect(op.get_bind()).get_columns(table)
+    return any(item["name"] == column for item in columns)
+
+
+def merge_duplicate_users() -> None:
+    """Переносит твиты, лайки и подписки пользователей-дублей на
+    пользователя с тем же именем и меньшим id, удаляет дубли
+    и пересчитывает счетчики"""
+    op.execute(
+        "CREATE TEMPORARY TABLE user_duplicates AS "
+        "SELECT id, keep_id FROM (SELECT id, "
+        "min(id) OVER (PARTITION BY name) AS keep_id FROM users) u "
+        "WHERE id <> keep_id"
+    )
+    duplicates = op.get_bind().scalar(
+        sa.text("SELECT count(*) FROM user_duplicates")
+    )
+    if duplicates:
+        op.execute(
+            "UPDATE tweets SET user_id = d.keep_id FROM user_duplicates d "
+            "WHERE tweets.user_id = d.id"
+        )
+        op.execute(
+            "INSERT INTO likes (tweet_id, user_id) "
+            "SELECT l.tweet_id, d.keep_id FROM likes l "
+            "JOIN user_duplicates d ON d.id = l.user_id "
+            "ON CONFLICT DO NOTHING"
+        )
+        op.execute(
+            "INSERT INTO follows (follower_id, followee_id) "
+            "SELECT * FROM (SELECT "
+            "coalesce(a.keep_id, f.follower_id) AS follower_id, "
+            "coalesce(b.keep_id, f.followee_id) AS followee_id "
+            "FROM follows f "
+            "LEFT JOIN user_duplicates a ON a.id = f.follower_id "
+            "LEFT JOIN user_duplicates b ON b.id = f.followee_id "
+            "WHERE a.id IS NOT NULL OR b.id IS NOT NULL) merged "
+            "WHERE follower_id <> followee_id "
+            "ON CONFLICT DO NOTHING"
+        )
+        # лайки, подписки и ленты дублей удаляются каскадно
+        op.execute(
+            "DELETE FROM users WHERE id IN (SELECT id FROM user_duplicates)"
+        )
+        op.execute(
+            "UPDATE tweets SET like_count = "
+            "(SELECT count(*) FROM likes WHERE likes.tweet_id = tweets.id)"
+        )
+        op.execute(
+            "UPDATE users SET followers_count = (SELECT count(*) "
+            "FROM follows WHERE follows.followee_id = users.id)"
+        )
+    op.execute("DROP TABLE user_duplicates")
+
+
+def upgrade() -> None:
+    op.execute(
+        "CREATE TABLE IF NOT EXISTS likes ("
+        "tweet_id INTEGER NOT NULL, "
+        "user_id INTEGER NOT NULL, "
+        "PRIMARY KEY (tweet_id, user_id), "
+        "FOREIGN KEY (tweet_id) REFERENCES tweets (id) ON DELETE CASCADE, "
+        "FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE)"
+    )
+    op.execute(
+        "CREATE TABLE IF NOT EXISTS follows ("
+        "follower_id INTEGER NOT NULL, "
+        "followee_id INTEGER NOT NULL, "
+        "PRIMARY KEY (follower_id, followee_id), "
+        "FOREIGN KEY (follower_id) REFERENCES users (id) ON DELETE CASCADE, "
+        "FOREIGN KEY (followee_id) REFERENCES users (id) ON DELETE CASCADE)"
+    )
+    op.execute(
+        "CREATE INDEX IF NOT EXISTS ix_follows_followee_follower "
+        "ON follows (followee_id, follower_id)"
+    )
+    op.execute(
+        "CREATE TABLE IF NOT EXISTS timelines ("
+        "user_id INTEGER NOT NULL, "
+        "tweet_id INTEGER NOT NULL, "
+        "PRIMARY KEY (user_id, tweet_id), "
+        "FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE, "
+        "FOREIGN KEY (tweet_id) REFERENCES tweets (id) ON DELETE CASCADE)"
+    )
+    op.execute(
+        "CREATE INDEX IF NOT EXISTS ix_timelines_tweet_id "
+        "ON timelines (tweet_id)"
+    )
+    op.execute(
+        "CREATE TABLE IF NOT EXISTS media_variants ("
+        "media_id INTEGER NOT NULL, "
+        "size VARCHAR NOT NULL, "
+        "filename VARCHAR NOT NULL, "
+        "content_type VARCHAR NOT NULL, "
+        "width INTEGER NOT NULL, "
+        "height INTEGER NOT NULL, "
+        "PRIMARY KEY (media_id, size), "
+        "FOREIGN KEY (media_id) REFERENCES medias (id) ON DELETE CASCADE)"
+    )
+
+    # лайки: массив tweets.likes -> таблица likes и счетчик like_count
+    if column_exists("tweets", "likes"):
+        op.execute(
+            "ALTER TABLE tweets "
+            "ADD COLUMN IF NOT EXISTS like_count integer NOT NULL DEFAULT 0"
+        )
+        op.execute(
+            "INSERT INTO likes (tweet_id, user_id) "
+            "SELECT t.id, u.id FROM tweets t "
+            "CROSS JOIN LATERAL unnest(t.likes) AS l(item) "
+            "JOIN users u ON u.id = (l.item ->> 'user_id')::int "
+            "ON CONFLICT DO NOTHING"
+        )
+        op.execute(
+            "UPDATE tweets SET like_count = "
+            "(SELECT count(*) FROM likes WHERE likes.tweet_id = tweets.id)"
+        )
+        op.execute("ALTER TABLE tweets DROP COLUMN likes")
+
+    # подписки: массивы users.followers/following -> таблица follows
+    if column_exists("users", "following"):
+        op.execute(
+            "INSERT INTO follows (follower_id, followee_id) "
+            "SELECT u.id, f.id FROM users u "
+            "CROSS JOIN LATERAL unnest(u.following) AS l(item) "
+            "JOIN users f ON f.id = (l.item ->> 'id')::int "
+            "UNION "
+            "SELECT f.id, u.id FROM users u "
+            "CROSS JOIN LATERAL unnest(u.followers) AS l(item) "
+            "JOIN users f ON f.id = (l.item ->> 'id')::int "
+            "ON CONFLICT DO NOTHING"
+        )
+        op.execute(
+            "ALTER TABLE users DROP COLUMN followers, DROP COLUMN following"
+        )
+
+    if not column_exists("users", "followers_count"):
+        op.execute(
+            "ALTER TABLE users "
+            "ADD COLUMN followers_count integer NOT NULL DEFAULT 0"
+        )
+        op.execute(
+            "UPDATE users SET followers_count = (SELECT count(*) "
+            "FROM follows WHERE follows.followee_id = users.id)"
+        )
+
+    merge_duplicate_users()
+    op.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_users_name ON users (name)"
+    )
+
+    # дедупликация изображений, уже загруженные остаются без хэша
+    op.execute(
+        "ALTER TABLE medias "
+        "ADD COLUMN IF NOT EXISTS sha256 varchar, "
+        "ADD COLUMN IF NOT EXISTS size bigint, "
+        "ADD COLUMN IF NOT EXISTS content_type varchar, "
+        "ADD COLUMN IF NOT EXISTS ref_count integer NOT NULL DEFAULT 1"
+    )
+    op.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_medias_sha256 "
+        "ON medias (sha256)"
+    )
+
+
+def downgrade() -> None:
+    op.execute("DROP INDEX IF EXISTS ix_medias_sha256")
+    op.execute(
+        "ALTER TABLE medias "
+        "DROP COLUMN IF EXISTS sha256, "
+        "DROP COLUMN IF EXISTS size, "
+        "DROP COLUMN IF EXISTS content_type, "
+        "DROP COLUMN IF EXISTS ref_count"
+    )
+    op.execute("DROP INDEX IF EXISTS ix_users_name")
+
+    # подписки: таблица follows -> массивы users.followers/following,
+    # порядок подписок не хранился, элементы упорядочены по id
+    op.execute(
+        "ALTER TABLE users "
+        "ADD COLUMN followers json[] NOT NULL DEFAULT '{}', "
+        "ADD COLUMN following json[] NOT NULL DEFAULT '{}'"
+    )
+    op.execute(
+        "UPDATE users SET "
+        "followers = coalesce((SELECT array_agg("
+        "json_build_object('id', u.id, 'name', u.name) ORDER BY u.id) "
+        "FROM follows f JOIN users u ON u.id = f.follower_id "
+        "WHERE f.followee_id = users.id), '{}'), "
+        "following = coalesce((SELECT array_agg("
+        "json_build_object('id', u.id, 'name', u.name) ORDER BY u.id) "
+        "FROM follows f JOIN users u ON u.id = f.followee_id "
+        "WHERE f.follower_id = users.id), '{}')"
+    )
+    op.execute(
+        "ALTER TABLE users "
+        "ALTER COLUMN followers DROP DEFAULT, "
+        "ALTER COLUMN following DROP DEFAULT, "
+        "DROP COLUMN followers_count"
+    )
+
+    # лайки: таблица likes -> массив tweets.likes
+    op.execute(
+        "ALTER TABLE tweets ADD COLUMN likes jsonb[] NOT NULL DEFAULT '{}'"
+    )
+    op.execute(
+        "UPDATE tweets SET likes = coalesce((SELECT array_agg("
+        "jsonb_build_object('user_id', u.id, 'name', u.name) ORDER BY u.id) "
+        "FROM likes l JOIN users u ON u.id = l.user_id "
+        "WHERE l.tweet_id = tweets.id), '{}')"
+    )
+    op.execute(
+        "ALTER TABLE tweets "
+        "ALTER COLUMN likes DROP DEFAULT, "
+        "DROP COLUMN like_count"
+    )
+
+    op.execute("DROP TABLE media_variants, timelines, follows, likes")
@@ -0,0 +1,53 @@
+"""Индексы для ленты, твитов автора и поиска файлов изображений
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17
+
+Индексы строятся CONCURRENTLY, без блокировки записи в таблицы.
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    # твиты автора и твиты подписок по id
+    ("ix_tweets_user_id_id", "tweets", ["user_id", "id"]),
+    # порядок ленты: like_count, id по убыванию
+    (
+        "ix_tweets_like_count_id",
+        "tweets",
+        [sa.text("like_count DESC"), sa.text("id DESC")],
+    ),
+    # проверка, используется ли файл, перед его удалением
+    ("ix_medias_filename", "medias", ["filename"]),
+    ("ix_media_variants_filename", "media_variants", ["filename"]),
+]
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(
+                name,
+                table,
+                columns,
+                postgresql_concurrently=True,
+                if_not_exists=True,
+            )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, _ in INDEXES:
+            op.drop_index(
+                name,
+                table_name=table,
+                postgresql_concurrently=True,
+                if_exists=True,
+            )
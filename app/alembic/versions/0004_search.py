@@ -0,0 +1,105 @@
+"""Полнотекстовый поиск по твитам и таблица хэштегов и упоминаний
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17
+
+Добавление вычисляемой колонки search_vector перезаписывает таблицу
+tweets. GIN-индекс строится CONCURRENTLY, без блокировки записи.
+Теги уже опубликованных твитов извлекаются тем же выражением,
+что и в app.functions.extract_tags, в Python: \\w в регулярных
+выражениях Postgres зависит от локали БД.
+"""
+
+import re
+
+import sqlalchemy as sa
+from alembic import context, op
+from sqlalchemy.dialects import postgresql
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+TAG_PATTERN = re.compile(r"(?<![\w#@])([#@]\w{1,100})(?!\w)")
+BATCH_SIZE = 10000
+
+
+def backfill_tags() -> None:
+    bind = op.get_bind()
+    last_id = 0
+    while True:
+        tweets = bind.execute(
+            sa.text(
+                "SELECT id, tweet_data FROM tweets "
+                "WHERE id > :last_id ORDER BY id LIMIT :limit"
+            ),
+            {"last_id": last_id, "limit": BATCH_SIZE},
+        ).all()
+        if not tweets:
+            return
+        last_id = tweets[-1].id
+
+        rows = [
+            {"tag": tag, "tweet_id": tweet.id}
+            for tweet in tweets
+            for tag in {
+                tag.lower() for tag in TAG_PATTERN.findall(tweet.tweet_data)
+            }
+        ]
+        if rows:
+            bind.execute(
+                sa.text(
+                    "INSERT INTO tweet_tags (tag, tweet_id) "
+                    "VALUES (:tag, :tweet_id) ON CONFLICT DO NOTHING"
+                ),
+                rows,
+            )
+
+
+def upgrade() -> None:
+    op.add_column(
+        "tweets",
+        sa.Column(
+            "search_vector",
+            postgresql.TSVECTOR(),
+            sa.Computed(
+                "to_tsvector('russian'::regconfig, (tweet_data)::text)",
+                persisted=True,
+            ),
+            nullable=True,
+        ),
+    )
+    op.create_table(
+        "tweet_tags",
+        sa.Column("tag", sa.String(), nullable=False),
+        sa.Column("tweet_id", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["tweet_id"], ["tweets.id"], ondelete="CASCADE"
+        ),
+        sa.PrimaryKeyConstraint("tag", "tweet_id"),
+    )
+    op.create_index("ix_tweet_tags_tweet_id", "tweet_tags", ["tweet_id"])
+    if not context.is_offline_mode():
+        backfill_tags()
+
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_tweets_search_vector",
+            "tweets",
+            ["search_vector"],
+            postgresql_using="gin",
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+
+
+def downgrade() -> None:
+    op.drop_index(
+        "ix_tweets_search_vector",
+        table_name="tweets",
+        postgresql_using="gin",
+    )
+    op.drop_table("tweet_tags")
+    op.drop_column("tweets", "search_vector")
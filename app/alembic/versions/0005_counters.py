@@ -0,0 +1,36 @@
+"""Счетчик просмотров твитов и журнал примененных сегментов счетчиков
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-17
+
+Колонка с постоянным значением по умолчанию добавляется без перезаписи
+таблицы tweets.
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "tweets",
+        sa.Column(
+            "view_count", sa.Integer(), server_default="0", nullable=False
+        ),
+    )
+    op.create_table(
+        "counter_segments",
+        sa.Column("name", sa.String(), nullable=False),
+        sa.PrimaryKeyConstraint("name"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("counter_segments")
+    op.drop_column("tweets", "view_count")
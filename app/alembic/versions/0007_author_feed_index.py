@@ -0,0 +1,39 @@
+"""Индекс твитов автора в порядке ленты
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-17
+
+Лента в режиме push читает твиты авторов, которые не раскладываются
+при публикации, по (like_count, id) после курсора отдельно у каждого
+автора. Индекс строится CONCURRENTLY, без блокировки записи в tweets.
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0007"
+down_revision = "0006"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_tweets_user_id_like_count_id",
+            "tweets",
+            ["user_id", sa.text("like_count DESC"), sa.text("id DESC")],
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            "ix_tweets_user_id_like_count_id",
+            table_name="tweets",
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
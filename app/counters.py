@@ -0,0 +1,326 @@
+"""Отложенная запись счетчиков твитов (write-behind).
+
+В режиме COUNTERS_MODE=buffered лайк сразу отвечает клиенту: строка
+likes вставляется в транзакции запроса, а изменение like_count
+дописывается в журнал процесса и накапливается в памяти. Просмотры
+(view_count) считаются так же в любом режиме. Раз в
+COUNTERS_FLUSH_INTERVAL секунд изменения, сложенные по твитам,
+применяются к tweets одной транзакцией, строки блокируются в порядке
+id, поэтому процессы не блокируют друг друга взаимно.
+
+Запросы не пишут журнал сами: изменения кладутся в очередь, а поток
+журнала дописывает все накопившиеся изменения одной записью (и одним
+fsync при COUNTERS_LOG_FSYNC), поэтому event loop не ждет диска.
+
+Журнал - файлы-сегменты в COUNTERS_LOG_DIR, у каждого процесса свои,
+процесс держит на них flock, пока они не применены. При сбросе текущий
+сегмент закрывается, имя сегмента записывается в counter_segments в той
+же транзакции, что и изменения счетчиков, поэтому сегмент, примененный
+перед сбоем, но не удаленный, повторно не применяется. Сегменты
+упавших процессов (без блокировки) применяет любой процесс при каждом
+сбросе. Если сброс изменил like_count, после него отправляется событие
+LIKE_COUNTS_CHANGED (порядок ленты зависит от лайков).
+"""
+
+import asyncio
+import fcntl
+import logging
+import os
+import queue
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable
+
+from sqlalchemy import Integer, column, delete, select, update, values
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from app import config, events
+from app.db_models import CounterSegmentsDB, TweetsDB
+
+logger = logging.getLogger(__name__)
+
+LIKES = "like_count"
+VIEWS = "view_count"
+COLUMNS = (LIKES, VIEWS)
+SEGMENT_SUFFIX = ".log"
+# Сколько секунд хранятся имена примененных сегментов
+SEGMENTS_RETENTION = 24 * 60 * 60
+
+Deltas = dict[int, dict[str, int]]
+
+
+def new_deltas() -> Deltas:
+    return defaultdict(lambda: dict.fromkeys(COLUMNS, 0))
+
+
+def liked_ids(deltas: Deltas) -> set[int]:
+    """Твиты, у которых меняется like_count"""
+    return {tweet_id for tweet_id, changes in deltas.items() if changes[LIKES]}
+
+
+def segment_name(created_ns: int) -> str:
+    """Имя сегмента: время создания (для удаления старых имен
+    по диапазону) и случайная часть"""
+    return f"{created_ns:020d}-{uuid.uuid4().hex}"
+
+
+class Segment:
+    """Файл журнала процесса, открытый на дозапись и заблокированный"""
+
+    def __init__(self, directory: str):
+        self.name = segment_name(time.time_ns())
+        self.path = os.path.join(directory, self.name + SEGMENT_SUFFIX)
+        # файл блокируется до того, как получит имя *.log, иначе его
+        # мог бы забрать сброс другого процесса
+        tmp_path = self.path + ".tmp"
+        self.file = open(tmp_path, "ab", buffering=0)
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        os.rename(tmp_path, self.path)
+
+    def append(self, lines: Iterable[str], fsync: bool) -> None:
+        self.file.write("".join(lines).encode())
+        if fsync:
+            os.fsync(self.file.fileno())
+
+    def remove(self) -> None:
+        """Удаляет примененный сегмент, блокировка снимается последней"""
+        os.remove(self.path)
+        self.file.close()
+
+
+def read_segment(path: str) -> Deltas:
+    """Изменения из файла сегмента, строка, оборванная при падении
+    процесса, пропускается"""
+    deltas = new_deltas()
+    with open(path, "rb") as file:
+        for line in file:
+            try:
+                tweet_id, name, delta = line.decode().split()
+                deltas[int(tweet_id)][name] += int(delta)
+            except (ValueError, KeyError, UnicodeDecodeError):
+                logger.warning("Пропущена строка журнала %s: %r", path, line)
+    return deltas
+
+
+async def apply_deltas(
+    name: str, deltas: Deltas, session: AsyncSession
+) -> bool:
+    """Применяет изменения сегмента к tweets, False - если сегмент уже
+    был применен"""
+    applied = await session.scalar(
+        insert(CounterSegmentsDB)
+        .values(name=name)
+        .on_conflict_do_nothing()
+        .returning(CounterSegmentsDB.name)
+    )
+    if applied is None:
+        return False
+
+    rows = [
+        (tweet_id, changes[LIKES], changes[VIEWS])
+        for tweet_id, changes in sorted(deltas.items())
+        if any(changes.values())
+    ]
+    if rows:
+        changes = values(
+            column("id", Integer),
+            column(LIKES, Integer),
+            column(VIEWS, Integer),
+            name="changes",
+        ).data(rows)
+        # строки блокируются по возрастанию id до обновления
+        await session.execute(
+            select(TweetsDB.id)
+            .where(TweetsDB.id.in_([row[0] for row in rows]))
+            .order_by(TweetsDB.id)
+            .with_for_update()
+        )
+        await session.execute(
+            update(TweetsDB)
+            .where(TweetsDB.id == changes.c.id)
+            .values(
+                like_count=TweetsDB.like_count + changes.c.like_count,
+                view_count=TweetsDB.view_count + changes.c.view_count,
+            )
+            .execution_options(synchronize_session=False)
+        )
+
+    expired = f"{time.time_ns() - SEGMENTS_RETENTION * 10**9:020d}"
+    await session.execute(
+        delete(CounterSegmentsDB).where(CounterSegmentsDB.name < expired)
+    )
+    return True
+
+
+class CounterBuffer:
+    """Буфер изменений счетчиков процесса с журналом на диске.
+
+    Текущий сегмент и накопленные изменения принадлежат потоку журнала
+    (executor с одним потоком): он пишет изменения из очереди и отдает
+    сегмент на применение, поэтому в сегменте ровно те изменения,
+    которые применяются вместе с ним"""
+
+    def __init__(self, directory: str, fsync: bool = False):
+        self.directory = directory
+        self.fsync = fsync
+        self.queue: queue.SimpleQueue[tuple[list[int], str, int]] = (
+            queue.SimpleQueue()
+        )
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="counters"
+        )
+        self.segment: Segment | None = None
+        self.deltas = new_deltas()
+        # закрытые сегменты (имя, файл, изменения), которые еще не удалось
+        # применить, файла нет, если журнал не удалось записать
+        self.pending: list[tuple[str, Segment | None, Deltas]] = []
+        self.lock = asyncio.Lock()
+        self.task: asyncio.Task | None = None
+
+    def add(self, tweet_ids: Iterable[int], name: str, delta: int = 1) -> None:
+        """Ставит изменение счетчика name твитов в очередь журнала,
+        не дожидаясь записи на диск"""
+        tweet_ids = list(tweet_ids)
+        if not tweet_ids:
+            return
+        self.queue.put((tweet_ids, name, delta))
+        self.executor.submit(self.write)
+
+    def write(self) -> None:
+        """Поток журнала: дописывает в сегмент все изменения из очереди
+        одной записью и добавляет их в буфер. Изменения, которые
+        не удалось записать, остаются в буфере и будут применены"""
+        changes = []
+        while True:
+            try:
+                changes.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if not changes:
+            return
+
+        for tweet_ids, name, delta in changes:
+            for tweet_id in tweet_ids:
+                self.deltas[tweet_id][name] += delta
+        try:
+            if self.segment is None:
+                os.makedirs(self.directory, exist_ok=True)
+                self.segment = Segment(self.directory)
+            self.segment.append(
+                (
+                    f"{tweet_id} {name} {delta}\n"
+                    for tweet_ids, name, delta in changes
+                    for tweet_id in tweet_ids
+                ),
+                fsync=self.fsync,
+            )
+        except OSError:
+            logger.exception("Не удалось записать журнал счетчиков")
+
+    def rotate(self) -> tuple[str, Segment | None, Deltas] | None:
+        """Поток журнала: дописывает очередь и закрывает текущий сегмент,
+        возвращает его вместе с изменениями"""
+        self.write()
+        if self.segment is None and not self.deltas:
+            return None
+        segment, deltas = self.segment, self.deltas
+        self.segment, self.deltas = None, new_deltas()
+        name = segment.name if segment else segment_name(time.time_ns())
+        return name, segment, deltas
+
+    async def flush(self, async_session: async_sessionmaker) -> None:
+        """Применяет накопленные изменения и сегменты упавших процессов"""
+        loop = asyncio.get_running_loop()
+        liked: set[int] = set()
+        try:
+            async with self.lock:
+                rotated = await loop.run_in_executor(
+                    self.executor, self.rotate
+                )
+                if rotated is not None:
+                    self.pending.append(rotated)
+
+                while self.pending:
+                    name, segment, deltas = self.pending[0]
+                    async with async_session() as session:
+                        if await apply_deltas(name, deltas, session):
+                            await session.commit()
+                            liked |= liked_ids(deltas)
+                    if segment is not None:
+                        segment.remove()
+                    self.pending.pop(0)
+
+                await self.recover(async_session, liked)
+        finally:
+            if liked:
+                await events.emit(
+                    events.LIKE_COUNTS_CHANGED, tweet_ids=sorted(liked)
+                )
+
+    async def recover(
+        self, async_session: async_sessionmaker, liked: set[int]
+    ) -> None:
+        """Применяет сегменты, которые не заблокированы живыми процессами,
+        в liked добавляет твиты, у которых изменился like_count"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+
+        for file_name in sorted(names):
+            if not file_name.endswith(SEGMENT_SUFFIX):
+                continue
+            path = os.path.join(self.directory, file_name)
+            try:
+                file = open(path, "rb")
+            except FileNotFoundError:
+                continue
+            with file:
+                try:
+                    fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                if not os.path.exists(path):
+                    continue
+
+                name = file_name.removesuffix(SEGMENT_SUFFIX)
+                deltas = await asyncio.get_running_loop().run_in_executor(
+                    None, read_segment, path
+                )
+                async with async_session() as session:
+                    if await apply_deltas(name, deltas, session):
+                        await session.commit()
+                        logger.info("Применен сегмент счетчиков %s", name)
+                        liked |= liked_ids(deltas)
+                os.remove(path)
+
+    async def run(self, async_session: async_sessionmaker) -> None:
+        while True:
+            await asyncio.sleep(config.COUNTERS_FLUSH_INTERVAL)
+            try:
+                await self.flush(async_session)
+            except Exception:
+                logger.exception("Не удалось применить счетчики")
+
+    def start(self, async_session: async_sessionmaker) -> None:
+        """Запускает периодический сброс в фоне"""
+        self.task = asyncio.create_task(self.run(async_session))
+
+    async def stop(self, async_session: async_sessionmaker) -> None:
+        """Останавливает фоновый сброс и применяет остаток буфера.
+        Если БД недоступна, изменения остаются в журнале"""
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        try:
+            await self.flush(async_session)
+        except Exception:
+            logger.exception("Счетчики остались в журнале %s", self.directory)
+
+
+counter_buffer = CounterBuffer(
+    directory=config.COUNTERS_LOG_DIR, fsync=config.COUNTERS_LOG_FSYNC
+)
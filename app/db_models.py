@@ -1,8 +1,15 @@
-from sqlalchemy import ForeignKey
-from sqlalchemy.dialects.postgresql import ARRAY, INTEGER, JSON, JSONB
+from datetime import datetime
+
+from sqlalchemy import BigInteger, Computed, ForeignKey, Index, func, text
+from sqlalchemy.dialects.postgresql import ARRAY, INTEGER, JSONB, TSVECTOR
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 
+# Конфигурация полнотекстового поиска: русские слова и английские
+# (asciiword) приводятся к основе. Изменение требует миграции
+TEXT_SEARCH_CONFIG = "russian"
+
+
 class Base(DeclarativeBase):
     def to_dict(self):
         return {c.name: getattr(self, c.name) for c in self.__table__.columns}
@@ -13,16 +20,17 @@ class Base(DeclarativeBase):
 class UsersDB(Base):
     __tablename__ = "users"
     id: Mapped[int] = mapped_column(primary_key=True)
-    name: Mapped[str]
-    followers: Mapped[list] = mapped_column(ARRAY(JSON))
-    following: Mapped[list] = mapped_column(ARRAY(JSON))
+    name: Mapped[str] = mapped_column(unique=True, index=True)
+    followers_count: Mapped[int] = mapped_column(default=0, server_default="0")
 
+    # связи не загружаются неявно (lazy="raise"): запросы сами выбирают
+    # нужные колонки или явно указывают стратегию загрузки
     tweets: Mapped[list["TweetsDB"]] = relationship(
-        "TweetsDB", back_populates="user", uselist=True, lazy="selectin"
+        "TweetsDB", back_populates="user", uselist=True, lazy="raise"
     )
 
     def __str__(self):
-        return f"{self.name=} {self.following=} {self.followers=}"
+        return f"{self.id=} {self.name=}"
 
 
 class TweetsDB(Base):
@@ -31,17 +39,169 @@ class TweetsDB(Base):
     tweet_data: Mapped[str]
     tweet_media_ids: Mapped[list[int]] = mapped_column(ARRAY(INTEGER))
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
-    likes: Mapped[list[dict]] = mapped_column(ARRAY(JSONB))
+    like_count: Mapped[int] = mapped_column(default=0, server_default="0")
+    view_count: Mapped[int] = mapped_column(default=0, server_default="0")
+    # вычисляется Postgres из tweet_data, в запросы твитов не попадает
+    search_vector: Mapped[str] = mapped_column(
+        TSVECTOR,
+        Computed(
+            f"to_tsvector('{TEXT_SEARCH_CONFIG}'::regconfig, "
+            "(tweet_data)::text)",
+            persisted=True,
+        ),
+        deferred=True,
+    )
 
     user: Mapped["UsersDB"] = relationship(
-        "UsersDB", back_populates="tweets", uselist=False, lazy="selectin"
+        "UsersDB", back_populates="tweets", uselist=False, lazy="raise"
+    )
+
+    # твиты автора по id и в порядке ленты, порядок ленты (like_count, id)
+    # по убыванию и полнотекстовый поиск
+    __table_args__ = (
+        Index("ix_tweets_user_id_id", "user_id", "id"),
+        Index(
+            "ix_tweets_user_id_like_count_id",
+            "user_id",
+            text("like_count DESC"),
+            text("id DESC"),
+        ),
+        Index(
+            "ix_tweets_like_count_id",
+            text("like_count DESC"),
+            text("id DESC"),
+        ),
+        Index(
+            "ix_tweets_search_vector",
+            "search_vector",
+            postgresql_using="gin",
+        ),
     )
 
     def __str__(self):
-        return f"{self.id=} {self.tweet_data=} {self.tweet_media_ids=} {self.user_id=} {self.likes=}"
+        return f"{self.id=} {self.tweet_data=} {self.tweet_media_ids=} {self.user_id=} {self.like_count=}"
 
 
 class MediaDB(Base):
     __tablename__ = "medias"
     id: Mapped[int] = mapped_column(primary_key=True)
-    filename: Mapped[str]
+    # путь относительно MEDIA_ROOT
+    filename: Mapped[str] = mapped_column(index=True)
+    # одинаковые изображения хранятся один раз, ref_count - сколько раз
+    # изображение было загружено и еще не удалено вместе с твитом
+    sha256: Mapped[str | None] = mapped_column(unique=True, index=True)
+    size: Mapped[int | None] = mapped_column(BigInteger)
+    content_type: Mapped[str | None]
+    ref_count: Mapped[int] = mapped_column(default=1, server_default="1")
+
+
+class LikesDB(Base):
+    __tablename__ = "likes"
+    tweet_id: Mapped[int] = mapped_column(
+        ForeignKey("tweets.id", ondelete="CASCADE"), primary_key=True
+    )
+    user_id: Mapped[int] = mapped_column(
+        ForeignKey("users.id", ondelete="CASCADE"), primary_key=True
+    )
+
+    def __str__(self):
+        return f"{self.tweet_id=} {self.user_id=}"
+
+
+class FollowsDB(Base):
+    __tablename__ = "follows"
+    follower_id: Mapped[int] = mapped_column(
+        ForeignKey("users.id", ondelete="CASCADE"), primary_key=True
+    )
+    followee_id: Mapped[int] = mapped_column(
+        ForeignKey("users.id", ondelete="CASCADE"), primary_key=True
+    )
+
+    # первичный ключ обслуживает "на кого подписан", индекс - "кто подписан"
+    __table_args__ = (
+        Index("ix_follows_followee_follower", "followee_id", "follower_id"),
+    )
+
+    def __str__(self):
+        return f"{self.follower_id=} {self.followee_id=}"
+
+
+class TweetTagsDB(Base):
+    """Хэштеги (#tag) и упоминания (@name) твитов в нижнем регистре,
+    заполняются при публикации. Первичный ключ обслуживает выборку
+    твитов по тегу от новых к старым"""
+
+    __tablename__ = "tweet_tags"
+    tag: Mapped[str] = mapped_column(primary_key=True)
+    tweet_id: Mapped[int] = mapped_column(
+        ForeignKey("tweets.id", ondelete="CASCADE"),
+        primary_key=True,
+        index=True,
+    )
+
+    def __str__(self):
+        return f"{self.tag=} {self.tweet_id=}"
+
+
+class TimelinesDB(Base):
+    """Материализованная домашняя лента: твиты авторов, на которых
+    подписан пользователь, заполняется при публикации (fan-out on write)"""
+
+    __tablename__ = "timelines"
+    user_id: Mapped[int] = mapped_column(
+        ForeignKey("users.id", ondelete="CASCADE"), primary_key=True
+    )
+    tweet_id: Mapped[int] = mapped_column(
+        ForeignKey("tweets.id", ondelete="CASCADE"),
+        primary_key=True,
+        index=True,
+    )
+
+    def __str__(self):
+        return f"{self.user_id=} {self.tweet_id=}"
+
+
+class MediaVariantsDB(Base):
+    """Уменьшенные копии изображения (thumb, medium)"""
+
+    __tablename__ = "media_variants"
+    media_id: Mapped[int] = mapped_column(
+        ForeignKey("medias.id", ondelete="CASCADE"), primary_key=True
+    )
+    size: Mapped[str] = mapped_column(primary_key=True)
+    filename: Mapped[str] = mapped_column(index=True)
+    content_type: Mapped[str]
+    width: Mapped[int]
+    height: Mapped[int]
+
+    def __str__(self):
+        return f"{self.media_id=} {self.size=} {self.filename=}"
+
+
+class CounterSegmentsDB(Base):
+    """Примененные сегменты журнала счетчиков (app.counters): повторное
+    применение сегмента после сбоя пропускается. Имя начинается
+    со времени создания сегмента, старые записи удаляются по диапазону
+    первичного ключа"""
+
+    __tablename__ = "counter_segments"
+    name: Mapped[str] = mapped_column(primary_key=True)
+
+    def __str__(self):
+        return f"{self.name=}"
+
+
+class OutboxDB(Base):
+    """События изменений (app.outbox), записываются в транзакции
+    обработчика и читаются диспетчером по возрастанию id"""
+
+    __tablename__ = "outbox"
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    event: Mapped[str]
+    payload: Mapped[dict] = mapped_column(JSONB)
+    created_at: Mapped[datetime] = mapped_column(
+        server_default=func.now(), index=True
+    )
+
+    def __str__(self):
+        return f"{self.id=} {self.event=} {self.payload=}"
@@ -0,0 +1,45 @@
+"""Внутренние события приложения.
+
+Обработчики запросов после фиксации транзакции сообщают, что изменилось
+(твиты, лайки, подписки), подписчики - например, кэш ленты - реагируют
+на эти события. Ошибка подписчика не влияет на ответ обработчика.
+"""
+
+import logging
+from collections import defaultdict
+from typing import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+TWEET_CREATED = "tweet_created"
+TWEET_DELETED = "tweet_deleted"
+LIKE_ADDED = "like_added"
+LIKE_REMOVED = "like_removed"
+FOLLOWED = "followed"
+UNFOLLOWED = "unfollowed"
+# сброс буфера счетчиков изменил like_count (COUNTERS_MODE=buffered)
+LIKE_COUNTS_CHANGED = "like_counts_changed"
+
+Handler = Callable[..., Awaitable[None]]
+
+handlers: dict[str, list[Handler]] = defaultdict(list)
+
+
+def on(*events: str) -> Callable[[Handler], Handler]:
+    """Декоратор, подписывает функцию на события"""
+
+    def decorator(handler: Handler) -> Handler:
+        for event in events:
+            handlers[event].append(handler)
+        return handler
+
+    return decorator
+
+
+async def emit(event: str, **payload) -> None:
+    """Вызывает подписчиков события по очереди"""
+    for handler in handlers[event]:
+        try:
+            await handler(event=event, **payload)
+        except Exception:
+            logger.exception("Ошибка обработчика события %s", event)
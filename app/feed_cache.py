@@ -0,0 +1,344 @@
+"""Кэш страниц ленты.
+
+Готовый JSON страницы хранится по ключу (пользователь, limit, cursor)
+вместе с поколениями ленты. Подписка и отписка увеличивают поколение
+подписчика. Старые записи не удаляются, их ключи просто перестают
+запрашиваться и вытесняются по LRU/ttl.
+
+Лента ранжирует все твиты по лайкам, поэтому точно сбрасывать ее можно
+только целиком на каждый твит и лайк, и при постоянной записи кэш почти
+не попадает. Что сбрасывается, задает FEED_CACHE_INVALIDATION:
+- scoped - твит или его удаление сбрасывают ленту автора и страницы
+  его подписчиков (со страницей сохраняются поколения авторов, на
+  которых подписан пользователь), лайк - ленту поставившего его.
+  Лайки других пользователей, сброс отложенных счетчиков и твиты
+  авторов без подписки появляются в ленте не позже FEED_CACHE_TTL;
+- global - твит, его удаление, лайк и сброс отложенных счетчиков лайков
+  увеличивают общее поколение, лента всегда актуальна.
+
+Хранилища:
+- local - LRU в памяти процесса, подходит для одного процесса приложения;
+- redis - общее для всех процессов, поколения хранятся без ttl, поэтому
+  redis нужно настроить с maxmemory-policy volatile-lru;
+- none - кэш выключен.
+"""
+
+import hashlib
+import logging
+import math
+from typing import Awaitable, Callable, NamedTuple
+
+from app import config, events, metrics
+from app.cache import TTLCache
+from app.config import (
+    FEED_CACHE_BACKEND,
+    FEED_CACHE_SIZE,
+    FEED_CACHE_TTL,
+    REDIS_URL,
+)
+from app.functions import decode_cursor
+
+logger = logging.getLogger(__name__)
+
+GLOBAL_GENERATION = "feed:generation"
+# Поколения авторов: TWEETS - при публикации и удалении твитов, DELETED -
+# только при удалении. ALL_AUTHORS - поколение всех авторов, от него
+# зависят страницы пользователей, подписанных больше чем на MAX_FOLLOWEES
+TWEETS = "tweets"
+DELETED = "deleted"
+ALL_AUTHORS = "*"
+MAX_FOLLOWEES = 1000
+
+
+class CachedFeed(NamedTuple):
+    """Страница ленты в виде готового JSON"""
+
+    etag: str
+    body: bytes
+
+    @classmethod
+    def from_body(cls, body: bytes) -> "CachedFeed":
+        return cls(etag=f'"{hashlib.sha1(body).hexdigest()}"', body=body)
+
+
+class NullBackend:
+    """Кэш выключен: поколений нет, страницы не сохраняются"""
+
+    async def get_generations(self, keys: list[str]) -> list[int] | None:
+        return None
+
+    async def incr(self, key: str) -> None:
+        pass
+
+    async def get(self, key: str) -> bytes | None:
+        return None
+
+    async def set(self, key: str, value: bytes) -> None:
+        pass
+
+    def clear(self) -> None:
+        pass
+
+
+class LocalBackend:
+    """Хранилище в памяти процесса"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.generations: dict[str, int] = {}
+
+    async def get_generations(self, keys: list[str]) -> list[int] | None:
+        return [self.generations.get(key, 0) for key in keys]
+
+    async def incr(self, key: str) -> None:
+        self.generations[key] = self.generations.get(key, 0) + 1
+
+    async def get(self, key: str) -> bytes | None:
+        return self.entries.get(key)
+
+    async def set(self, key: str, value: bytes) -> None:
+        self.entries.set(key, value)
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.generations.clear()
+
+
+class RedisBackend:
+    """Общее хранилище в redis. Если redis недоступен, лента
+    собирается из БД, как без кэша"""
+
+    def __init__(self, url: str, ttl: float):
+        import redis.asyncio
+
+        self.redis = redis.asyncio.from_url(url)
+        self.errors = redis.asyncio.RedisError
+        self.ttl = ttl
+
+    async def get_generations(self, keys: list[str]) -> list[int] | None:
+        try:
+            values = await self.redis.mget(keys)
+        except self.errors:
+            logger.warning("redis недоступен, кэш ленты пропущен")
+            return None
+        return [int(value or 0) for value in values]
+
+    async def incr(self, key: str) -> None:
+        try:
+            await self.redis.incr(key)
+        except self.errors:
+            logger.warning("redis недоступен, поколение %s не изменено", key)
+
+    async def get(self, key: str) -> bytes | None:
+        try:
+            return await self.redis.get(key)
+        except self.errors:
+            return None
+
+    async def set(self, key: str, value: bytes) -> None:
+        try:
+            await self.redis.set(key, value, ex=int(self.ttl) or None)
+        except self.errors:
+            pass
+
+    def clear(self) -> None:
+        pass
+
+
+class FeedCache:
+    def __init__(self, backend: NullBackend | LocalBackend | RedisBackend):
+        self.backend = backend
+
+    async def get_or_build(
+        self,
+        user_id: int,
+        limit: int,
+        cursor: str | None,
+        build: Callable[[bool], Awaitable[tuple[bytes, str | None]]],
+        followees: Callable[[int], Awaitable[list[int] | None]],
+    ) -> CachedFeed:
+        """Возвращает страницу ленты из кэша или собирает ее функцией
+        build (JSON и курсор следующей страницы) и сохраняет. Поколения
+        читаются до запроса к БД, поэтому страница, собранная во время
+        изменения, сохраняется под устаревшим ключом и не отдается.
+        build получает True, если страница будет сохранена: такую
+        страницу нужно собирать на основной БД, отстающая реплика
+        сохранила бы устаревшую страницу под новым поколением.
+
+        При FEED_CACHE_INVALIDATION=scoped вместе со страницей
+        сохраняются поколения авторов, на которых подписан пользователь
+        (followees(limit) - их id или None, если их больше limit),
+        страница отдается, пока они не изменились. Если на страницу
+        не встанет новый твит (shows_new_tweets), она зависит только
+        от удаления твитов"""
+        generations = await self.backend.get_generations(
+            [GLOBAL_GENERATION, user_generation(user_id)]
+        )
+        if generations is None:
+            metrics.feed_cache_requests.inc(("bypass",))
+            return CachedFeed.from_body((await build(False))[0])
+
+        key = "feed:{}:{}:{}:{}:{}".format(
+            user_id, *generations, limit, cursor or ""
+        )
+        value = await self.backend.get(key)
+        if value is not None:
+            etag, authors, body = value.split(b"\n", 2)
+            if await self.authors_unchanged(authors):
+                metrics.feed_cache_requests.inc(("hit",))
+                return CachedFeed(etag=etag.decode(), body=body)
+
+        snapshots = {TWEETS: b"", DELETED: b""}
+        if config.FEED_CACHE_INVALIDATION == "scoped":
+            names = await self.followee_names(
+                user_id, generations[1], followees
+            )
+            snapshots = await self.authors_snapshots(names)
+            if snapshots is None:
+                metrics.feed_cache_requests.inc(("bypass",))
+                return CachedFeed.from_body((await build(False))[0])
+
+        metrics.feed_cache_requests.inc(("miss",))
+        body, next_cursor = await build(True)
+        page = CachedFeed.from_body(body)
+        authors = snapshots[
+            TWEETS if shows_new_tweets(cursor, next_cursor) else DELETED
+        ]
+        await self.backend.set(
+            key, b"\n".join((page.etag.encode(), authors, page.body))
+        )
+        return page
+
+    async def followee_names(
+        self,
+        user_id: int,
+        generation: int,
+        followees: Callable[[int], Awaitable[list[int] | None]],
+    ) -> list[str]:
+        """Авторы, от которых зависят страницы пользователя: id подписок
+        или ALL_AUTHORS. Список хранится в кэше под поколением
+        пользователя, подписка и отписка его меняют"""
+        key = f"feed:followees:{user_id}:{generation}"
+        value = await self.backend.get(key)
+        if value is None:
+            author_ids = await followees(MAX_FOLLOWEES)
+            value = (
+                ALL_AUTHORS.encode()
+                if author_ids is None
+                else ",".join(map(str, author_ids)).encode()
+            )
+            await self.backend.set(key, value)
+        return value.decode().split(",") if value else []
+
+    async def authors_snapshots(
+        self, names: list[str]
+    ) -> dict[str, bytes] | None:
+        """Поколения авторов names для каждого вида изменений: вид,
+        затем id=поколение через запятую"""
+        if not names:
+            return {TWEETS: b"", DELETED: b""}
+        kinds = (TWEETS, DELETED)
+        generations = await self.backend.get_generations(
+            [author_generation(name, kind) for kind in kinds for name in names]
+        )
+        if generations is None:
+            return None
+        return {
+            kind: (
+                kind
+                + " "
+                + ",".join(
+                    f"{name}={generation}"
+                    for name, generation in zip(
+                        names, generations[i * len(names) :]
+                    )
+                )
+            ).encode()
+            for i, kind in enumerate(kinds)
+        }
+
+    async def authors_unchanged(self, snapshot: bytes) -> bool:
+        if not snapshot:
+            return True
+        kind, items = snapshot.decode().split(" ", 1)
+        names, stored = zip(*(item.split("=") for item in items.split(",")))
+        generations = await self.backend.get_generations(
+            [author_generation(name, kind) for name in names]
+        )
+        return generations is not None and list(stored) == [
+            str(generation) for generation in generations
+        ]
+
+    async def invalidate_all(self) -> None:
+        await self.backend.incr(GLOBAL_GENERATION)
+
+    async def invalidate_user(self, user_id: int) -> None:
+        await self.backend.incr(user_generation(user_id))
+
+    async def invalidate_author(self, author_id: int, deleted: bool) -> None:
+        """Автор опубликовал или удалил твиты: сбрасываются его лента
+        и страницы его подписчиков, на которых есть место для нового
+        твита, а при удалении - все их страницы"""
+        await self.backend.incr(user_generation(author_id))
+        for kind in (TWEETS, DELETED) if deleted else (TWEETS,):
+            for name in (str(author_id), ALL_AUTHORS):
+                await self.backend.incr(author_generation(name, kind))
+
+
+def user_generation(user_id: int) -> str:
+    return f"feed:generation:{user_id}"
+
+
+def author_generation(name: str, kind: str) -> str:
+    return f"feed:generation:{kind}:{name}"
+
+
+def shows_new_tweets(cursor: str | None, next_cursor: str | None) -> bool:
+    """Попадет ли на страницу новый твит подписки: у него нет лайков,
+    и он встает первым среди твитов подписок без лайков, то есть между
+    ключами (True, 0, id) и (True, 1, id). Страница с курсором cursor
+    занимает ключи от ключа курсора (не включая) до next_cursor"""
+    new = (True, 0, math.inf)
+    upper = decode_cursor(cursor) if cursor else None
+    lower = decode_cursor(next_cursor) if next_cursor else None
+    return (upper is None or new < upper) and (lower is None or lower < new)
+
+
+def make_backend() -> NullBackend | LocalBackend | RedisBackend:
+    if FEED_CACHE_BACKEND == "local":
+        return LocalBackend(maxsize=FEED_CACHE_SIZE, ttl=FEED_CACHE_TTL)
+    if FEED_CACHE_BACKEND == "redis":
+        return RedisBackend(url=REDIS_URL, ttl=FEED_CACHE_TTL)
+    return NullBackend()
+
+
+feed_cache = FeedCache(backend=make_backend())
+
+
+@events.on(events.TWEET_CREATED, events.TWEET_DELETED)
+async def invalidate_tweet_feeds(event: str, user_id: int, **payload) -> None:
+    if config.FEED_CACHE_INVALIDATION == "global":
+        await feed_cache.invalidate_all()
+    else:
+        await feed_cache.invalidate_author(
+            user_id, deleted=event == events.TWEET_DELETED
+        )
+
+
+@events.on(events.LIKE_ADDED, events.LIKE_REMOVED)
+async def invalidate_like_feeds(user_id: int, **payload) -> None:
+    if config.FEED_CACHE_INVALIDATION == "global":
+        await feed_cache.invalidate_all()
+    else:
+        await feed_cache.invalidate_user(user_id)
+
+
+@events.on(events.LIKE_COUNTS_CHANGED)
+async def invalidate_like_counts(**payload) -> None:
+    if config.FEED_CACHE_INVALIDATION == "global":
+        await feed_cache.invalidate_all()
+
+
+@events.on(events.FOLLOWED, events.UNFOLLOWED)
+async def invalidate_follower_feed(user_id: int, **payload) -> None:
+    await feed_cache.invalidate_user(user_id)
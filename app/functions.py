@@ -1,34 +1,269 @@
-from sqlalchemy import select, delete
-from sqlalchemy.ext.asyncio import AsyncSession
+import base64
+import json
+import logging
+import re
+from typing import NamedTuple
 
-from app.db_models import UsersDB, MediaDB, TweetsDB
+from PIL import Image
+from sqlalchemy import (
+    CTE,
+    Row,
+    Select,
+    Text,
+    cast,
+    column,
+    func,
+    select,
+    delete,
+    update,
+    tuple_,
+    literal,
+    literal_column,
+    union,
+    union_all,
+)
+from sqlalchemy.dialects.postgresql import (
+    insert,
+    aggregate_order_by,
+    ARRAY,
+    INTEGER,
+    JSON,
+)
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql.functions import Function
 
+from app.cache import TTLCache
+from app.config import FOLLOW_LIST_LIMIT, AUTH_CACHE_SIZE, AUTH_CACHE_TTL
+from app.routes_models import TweetIn
+from app.media import (
+    MEDIA_URL_PREFIX,
+    StoredFile,
+    make_variants,
+    media_url_query,
+    remove_media_file,
+)
+from app.db_models import (
+    TEXT_SEARCH_CONFIG,
+    UsersDB,
+    MediaDB,
+    MediaVariantsDB,
+    TweetsDB,
+    TweetTagsDB,
+    LikesDB,
+    FollowsDB,
+)
 
-async def get_user(
-    session: AsyncSession,
-    username: str | None = None,
-    user_id: int | None = None,
-) -> UsersDB | None:
-    """Делает запрос к БД, возвращает объект пользователя"""
-    if username:
-        user = await session.execute(
-            select(UsersDB).where(UsersDB.name == username)
+logger = logging.getLogger(__name__)
+
+
+class UserIdentity(NamedTuple):
+    """Пользователь, от имени которого выполняется запрос"""
+
+    id: int
+    name: str
+
+
+# Api-Key -> UserIdentity, имя пользователя не меняется, поэтому запись
+# можно хранить до истечения ttl
+user_cache = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)
+
+
+async def get_user_identity(
+    username: str, session: AsyncSession
+) -> UserIdentity | None:
+    """Возвращает id и имя пользователя по Api-Key, сначала ищет в кэше.
+    Из БД читаются только две колонки по уникальному индексу users.name"""
+    user = user_cache.get(username)
+    if user:
+        return user
+
+    row = (
+        await session.execute(
+            select(UsersDB.id, UsersDB.name).where(UsersDB.name == username)
         )
-    else:
-        user = await session.execute(
-            select(UsersDB).where(UsersDB.id == user_id)
+    ).first()
+    if not row:
+        return None
+
+    user = UserIdentity(*row)
+    user_cache.set(username, user)
+    return user
+
+
+async def create_user(username: str, session: AsyncSession) -> UserIdentity:
+    """Создает пользователя, если его еще нет, и возвращает его"""
+    inserted = await session.execute(
+        insert(UsersDB)
+        .values(name=username)
+        .on_conflict_do_nothing(index_elements=[UsersDB.name])
+        .returning(UsersDB.id)
+    )
+    user_id = inserted.scalar()
+    if user_id is None:
+        user_id = await session.scalar(
+            select(UsersDB.id).where(UsersDB.name == username)
         )
-    return user.scalar()
 
+    user_cache.delete(username)
+    return UserIdentity(id=user_id, name=username)
 
-async def del_media(media_id: int, session: AsyncSession) -> str | None:
-    """Удаляет запись в БД об изображении"""
-    filename = await session.execute(
+
+async def add_media(
+    stored: StoredFile, session: AsyncSession
+) -> tuple[int, str]:
+    """Добавляет запись об изображении, возвращает id и имя файла.
+    Если изображение с таким же SHA-256 уже есть, увеличивает его счетчик
+    ссылок и возвращает его id и файл (у изображений, загруженных раньше,
+    имя файла может отличаться от stored.filename)"""
+    media = await session.execute(
+        insert(MediaDB)
+        .values(
+            filename=stored.filename,
+            sha256=stored.sha256,
+            size=stored.size,
+            content_type=stored.content_type,
+        )
+        .on_conflict_do_update(
+            index_elements=[MediaDB.sha256],
+            set_={"ref_count": MediaDB.ref_count + 1},
+        )
+        .returning(MediaDB.id, MediaDB.filename)
+    )
+    media_id, filename = media.one()
+    return media_id, filename
+
+
+async def delete_tweet(
+    tweet_id: int, user_id: int, session: AsyncSession
+) -> list[str] | None:
+    """Удаляет твит пользователя и освобождает его изображения.
+    Возвращает имена файлов, которые больше не нужны, или None,
+    если у пользователя нет такого твита"""
+    media_ids = await session.scalar(
+        delete(TweetsDB)
+        .where(TweetsDB.id == tweet_id, TweetsDB.user_id == user_id)
+        .returning(TweetsDB.tweet_media_ids)
+    )
+    if media_ids is None:
+        return None
+    return await release_medias(media_ids=media_ids, session=session)
+
+
+async def release_medias(
+    media_ids: list[int], session: AsyncSession
+) -> list[str]:
+    """Уменьшает счетчики ссылок изображений двумя запросами независимо
+    от их числа. Изображения без ссылок удаляются из БД вместе
+    с уменьшенными копиями, возвращаются имена их файлов"""
+    if not media_ids:
+        return []
+
+    released = (
+        select(
+            column("media_id", INTEGER),
+            func.count().label("references"),
+        )
+        .select_from(
+            func.unnest(literal(media_ids, ARRAY(INTEGER))).alias("media_id")
+        )
+        .group_by(column("media_id"))
+        .cte("released")
+    )
+    await session.execute(
+        update(MediaDB)
+        .where(MediaDB.id == released.c.media_id)
+        .values(ref_count=MediaDB.ref_count - released.c.references)
+        .execution_options(synchronize_session=False)
+    )
+
+    deleted = (
         delete(MediaDB)
-        .where(MediaDB.id == media_id)
-        .returning(MediaDB.filename)
+        .where(MediaDB.id.in_(media_ids), MediaDB.ref_count <= 0)
+        .returning(MediaDB.id, MediaDB.filename)
+        .cte("deleted")
+    )
+    # копии удаляются каскадно, их имена читаются из снимка до удаления
+    filenames = await session.execute(
+        union_all(
+            select(deleted.c.filename),
+            select(MediaVariantsDB.filename).join(
+                deleted, deleted.c.id == MediaVariantsDB.media_id
+            ),
+        )
+    )
+    return list(filenames.scalars())
+
+
+async def cleanup_media_files(
+    filenames: list[str], async_session: async_sessionmaker
+) -> None:
+    """Фоновая задача после удаления твита: удаляет файлы изображений.
+    Файл, на который к этому моменту снова сослались (повторная загрузка
+    того же изображения), остается на диске"""
+    async with async_session() as session:
+        in_use = await session.scalars(
+            union_all(
+                select(MediaDB.filename).where(
+                    MediaDB.filename.in_(filenames)
+                ),
+                select(MediaVariantsDB.filename).where(
+                    MediaVariantsDB.filename.in_(filenames)
+                ),
+            )
+        )
+        in_use = set(in_use)
+
+    for filename in filenames:
+        if filename not in in_use:
+            await remove_media_file(filename)
+
+
+async def process_media(
+    media_id: int, filename: str, async_session: async_sessionmaker
+) -> None:
+    """Фоновая задача после загрузки: создает уменьшенные копии
+    изображения и записывает их в media_variants"""
+    async with async_session() as session:
+        exists = await session.scalar(
+            select(MediaVariantsDB.media_id)
+            .where(MediaVariantsDB.media_id == media_id)
+            .limit(1)
+        )
+    if exists:
+        return
+
+    try:
+        variants = await make_variants(filename)
+    except (OSError, Image.DecompressionBombError):
+        logger.warning("Не удалось уменьшить изображение %s", media_id)
+        return
+
+    if not variants:
+        return
+
+    async with async_session() as session:
+        await session.execute(
+            insert(MediaVariantsDB)
+            .values(
+                [
+                    {"media_id": media_id, **variant._asdict()}
+                    for variant in variants
+                ]
+            )
+            .on_conflict_do_nothing()
+        )
+        await session.commit()
+
+
+async def get_media_variant(
+    media_id: int, size: str, session: AsyncSession
+) -> MediaVariantsDB | None:
+    return await session.scalar(
+        select(MediaVariantsDB).where(
+            MediaVariantsDB.media_id == media_id, MediaVariantsDB.size == size
+        )
     )
-    return filename.scalars().one_or_none()
 
 
 async def get_tweet(tweet_id: int, session: AsyncSession) -> TweetsDB | None:
@@ -43,3 +278,823 @@ async def get_media(media_id: int, session: AsyncSession) -> MediaDB | None:
         select(MediaDB).where(MediaDB.id == media_id)
     )
     return media.scalar()
+
+
+class CursorError(Exception):
+    """Исключение о том, что передан некорректный курсор пагинации"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.type = "CursorError"
+
+
+def encode_cursor(*keys: bool | int | float) -> str:
+    """Упаковывает ключи последней записи страницы в непрозрачный курсор"""
+    raw = json.dumps(keys, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[bool, int, int]:
+    """Распаковывает курсор ленты в (is_followed, like_count, id)"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        is_followed, like_count, tweet_id = json.loads(raw)
+    except (ValueError, TypeError):
+        raise CursorError(name="Некорректный курсор")
+
+    if (
+        not isinstance(is_followed, bool)
+        or type(like_count) is not int
+        or type(tweet_id) is not int
+    ):
+        raise CursorError(name="Некорректный курсор")
+    return is_followed, like_count, tweet_id
+
+
+# Колонки, из которых собирается твит ленты: автор подтягивается
+# join-ом users, ORM-объекты и их связи не загружаются
+FEED_COLUMNS = (
+    TweetsDB.id,
+    TweetsDB.tweet_data,
+    TweetsDB.tweet_media_ids,
+    TweetsDB.user_id,
+    UsersDB.name.label("author_name"),
+)
+
+
+def followees_query(user_id: int) -> Select:
+    """id авторов, на которых подписан пользователь"""
+    return select(FollowsDB.followee_id).where(
+        FollowsDB.follower_id == user_id
+    )
+
+
+async def get_followee_ids(
+    user_id: int, session: AsyncSession, limit: int
+) -> list[int] | None:
+    """id авторов, на которых подписан пользователь, None - если
+    их больше limit"""
+    followee_ids = (
+        await session.scalars(followees_query(user_id).limit(limit + 1))
+    ).all()
+    return None if len(followee_ids) > limit else list(followee_ids)
+
+
+def ranked_tweets_query(
+    is_followed: bool, limit: int, keys: tuple[bool, int, int] | None
+) -> Select:
+    """Сегмент ленты: твиты по (like_count, id) по убыванию, после ключа
+    keys, если он задан. Порядок обслуживается индексом
+    ix_tweets_like_count_id, условия отбора добавляет вызывающий код"""
+    query = (
+        select(
+            *FEED_COLUMNS,
+            literal(is_followed).label("is_followed"),
+            TweetsDB.like_count.label("like_count"),
+        )
+        .join(UsersDB, UsersDB.id == TweetsDB.user_id)
+        .order_by(TweetsDB.like_count.desc(), TweetsDB.id.desc())
+        .limit(limit)
+    )
+    if keys:
+        query = query.where(
+            tuple_(TweetsDB.like_count, TweetsDB.id) < tuple_(*keys[1:])
+        )
+    return query
+
+
+def merge_segments(segments: list[Select], limit: int) -> Select:
+    """Объединяет сегменты ленты в страницу (limit + 1 строк)
+    в порядке (is_followed, like_count, id) по убыванию"""
+    page = union_all(
+        *(segment.subquery().select() for segment in segments)
+    ).subquery()
+    return (
+        select(page)
+        .order_by(
+            page.c.is_followed.desc(),
+            page.c.like_count.desc(),
+            page.c.id.desc(),
+        )
+        .limit(limit + 1)
+    )
+
+
+def feed_page_query(
+    user_id: int, limit: int, cursor: str | None = None
+) -> Select:
+    """Запрос страницы ленты (колонки FEED_COLUMNS, is_followed
+    и like_count), limit + 1 строк.
+
+    Твиты упорядочены по (is_followed, like_count, id) по убыванию,
+    следующая страница выбирается по ключу последней записи (keyset).
+    Твиты подписок и остальные выбираются отдельными сегментами,
+    каждый по индексу, поэтому стоимость запроса не зависит от размера
+    таблицы"""
+    keys = decode_cursor(cursor) if cursor else None
+    followees = followees_query(user_id)
+
+    segments = []
+    if keys is None or keys[0]:
+        segments.append(
+            ranked_tweets_query(
+                is_followed=True, limit=limit + 1, keys=keys
+            ).where(TweetsDB.user_id.in_(followees))
+        )
+    segments.append(
+        ranked_tweets_query(
+            is_followed=False,
+            limit=limit + 1,
+            keys=keys if keys and not keys[0] else None,
+        ).where(TweetsDB.user_id.not_in(followees))
+    )
+    return merge_segments(segments=segments, limit=limit)
+
+
+async def get_feed_page(
+    session: AsyncSession,
+    user_id: int,
+    limit: int,
+    cursor: str | None = None,
+) -> tuple[list[Row], str | None]:
+    """Возвращает страницу ленты (строки с колонками FEED_COLUMNS)
+    и курсор следующей страницы"""
+    query = feed_page_query(user_id=user_id, limit=limit, cursor=cursor)
+    rows = (await session.execute(query)).all()
+    return make_page(rows=rows, limit=limit)
+
+
+def make_page(rows: list[Row], limit: int) -> tuple[list[Row], str | None]:
+    """Обрезает выборку (limit + 1 строк) до страницы и, если есть
+    следующая страница, строит курсор по последней записи"""
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(last.is_followed, last.like_count, last.id)
+
+    return rows, next_cursor
+
+
+def json_text(value) -> Function:
+    """Значение как JSON-литерал (строки экранируются Postgres)"""
+    return cast(func.to_json(value), Text)
+
+
+def json_list(item, *order_by) -> Function:
+    """Элементы, собранные через запятую (содержимое JSON-массива)"""
+    return func.coalesce(
+        func.string_agg(item, aggregate_order_by(literal(","), *order_by)),
+        "",
+    )
+
+
+async def get_feed_json_page(
+    session: AsyncSession, query: Select, limit: int
+) -> tuple[str, str | None]:
+    """Собирает JSON твитов страницы ленты в Postgres одним запросом.
+
+    query - запрос страницы (feed_page_query, timeline_page_query).
+    Возвращает содержимое массива tweets в форме TweetsForBand (тот же
+    порядок ключей и компактная запись, что у JSON_SERIALIZER=orjson)
+    и курсор следующей страницы"""
+    page = query.subquery()
+    ranked = select(
+        page,
+        func.row_number()
+        .over(
+            order_by=(
+                page.c.is_followed.desc(),
+                page.c.like_count.desc(),
+                page.c.id.desc(),
+            )
+        )
+        .label("position"),
+    ).subquery()
+
+    medias = (
+        func.unnest(ranked.c.tweet_media_ids)
+        .table_valued("media_id", with_ordinality="position")
+        .render_derived()
+    )
+    attachments = (
+        select(
+            json_list(
+                func.concat(
+                    '"',
+                    MEDIA_URL_PREFIX,
+                    medias.c.media_id,
+                    media_url_query(),
+                    '"',
+                ),
+                medias.c.position,
+            )
+        )
+        .select_from(medias)
+        .scalar_subquery()
+    )
+    likes = (
+        select(
+            json_list(
+                func.concat(
+                    '{"user_id":',
+                    UsersDB.id,
+                    ',"name":',
+                    json_text(UsersDB.name),
+                    "}",
+                ),
+                UsersDB.id,
+            )
+        )
+        .join(LikesDB, LikesDB.user_id == UsersDB.id)
+        .where(LikesDB.tweet_id == ranked.c.id)
+        .scalar_subquery()
+    )
+    tweet = func.concat(
+        '{"id":',
+        ranked.c.id,
+        ',"content":',
+        json_text(ranked.c.tweet_data),
+        ',"attachments":[',
+        attachments,
+        '],"author":{"id":',
+        ranked.c.user_id,
+        ',"name":',
+        json_text(ranked.c.author_name),
+        '},"likes":[',
+        likes,
+        "]}",
+    )
+    on_page = ranked.c.position <= limit
+    last = ranked.c.position == limit
+
+    row = (
+        await session.execute(
+            select(
+                func.coalesce(
+                    func.string_agg(
+                        tweet,
+                        aggregate_order_by(literal(","), ranked.c.position),
+                    ).filter(on_page),
+                    "",
+                ),
+                func.count(),
+                func.bool_or(ranked.c.is_followed).filter(last),
+                func.max(ranked.c.like_count).filter(last),
+                func.max(ranked.c.id).filter(last),
+            )
+        )
+    ).one()
+    tweets, count, *keys = row
+
+    next_cursor = encode_cursor(*keys) if count > limit else None
+    return tweets, next_cursor
+
+
+# Хэштег или упоминание: # или @ и до 100 букв, цифр и "_" (более
+# длинные не извлекаются). То же выражение в миграции 0004
+TAG_PATTERN = re.compile(r"(?<![\w#@])([#@]\w{1,100})(?!\w)")
+
+
+def extract_tags(text: str) -> set[str]:
+    """Хэштеги и упоминания текста в нижнем регистре: {"#tag", "@name"}"""
+    return {tag.lower() for tag in TAG_PATTERN.findall(text)}
+
+
+def is_tag(query: str) -> bool:
+    """Запрос поиска - один хэштег или упоминание"""
+    return TAG_PATTERN.fullmatch(query) is not None
+
+
+async def add_tweet_tags(
+    tweets: dict[int, str], session: AsyncSession
+) -> None:
+    """Сохраняет теги твитов {tweet_id: текст} одним запросом,
+    если они есть"""
+    rows = [
+        {"tag": tag, "tweet_id": tweet_id}
+        for tweet_id, text in tweets.items()
+        for tag in extract_tags(text)
+    ]
+    if rows:
+        await session.execute(
+            insert(TweetTagsDB).on_conflict_do_nothing(), rows
+        )
+
+
+def decode_search_cursor(cursor: str) -> tuple[float, int]:
+    """Распаковывает курсор поиска в (rank, id)"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        rank, tweet_id = json.loads(raw)
+    except (ValueError, TypeError):
+        raise CursorError(name="Некорректный курсор")
+
+    if type(rank) not in (int, float) or type(tweet_id) is not int:
+        raise CursorError(name="Некорректный курсор")
+    return rank, tweet_id
+
+
+def search_page_query(
+    query: str, limit: int, cursor: str | None = None
+) -> Select:
+    """Запрос страницы поиска (колонки FEED_COLUMNS и rank), limit + 1
+    строк. Один хэштег или упоминание ищется по tweet_tags, твиты
+    от новых к старым. Остальные запросы (синтаксис websearch: "фраза",
+    or, -слово) ищутся по GIN-индексу search_vector, твиты упорядочены
+    по релевантности, затем по id. Следующая страница выбирается
+    по ключу последней записи"""
+    keys = decode_search_cursor(cursor) if cursor else None
+
+    if is_tag(query):
+        page = (
+            select(*FEED_COLUMNS, literal(0.0).label("rank"))
+            .join(TweetTagsDB, TweetTagsDB.tweet_id == TweetsDB.id)
+            .join(UsersDB, UsersDB.id == TweetsDB.user_id)
+            .where(TweetTagsDB.tag == query.lower())
+            .order_by(TweetTagsDB.tweet_id.desc())
+            .limit(limit + 1)
+        )
+        if keys:
+            page = page.where(TweetTagsDB.tweet_id < keys[1])
+        return page
+
+    tsquery = func.websearch_to_tsquery(
+        literal_column(f"'{TEXT_SEARCH_CONFIG}'::regconfig"), query
+    )
+    rank = func.ts_rank_cd(TweetsDB.search_vector, tsquery)
+    # Сначала выбираются id страницы, авторы присоединяются только к ним
+    ranked = (
+        select(TweetsDB.id, rank.label("rank"))
+        .where(TweetsDB.search_vector.op("@@")(tsquery))
+        .order_by(rank.desc(), TweetsDB.id.desc())
+        .limit(limit + 1)
+    )
+    if keys:
+        ranked = ranked.where(tuple_(rank, TweetsDB.id) < tuple_(*keys))
+    ranked = ranked.subquery()
+
+    return (
+        select(*FEED_COLUMNS, ranked.c.rank)
+        .join(ranked, ranked.c.id == TweetsDB.id)
+        .join(UsersDB, UsersDB.id == TweetsDB.user_id)
+        .order_by(ranked.c.rank.desc(), TweetsDB.id.desc())
+    )
+
+
+async def search_tweets(
+    session: AsyncSession,
+    query: str,
+    limit: int,
+    cursor: str | None = None,
+) -> tuple[list[Row], str | None]:
+    """Возвращает страницу найденных твитов (строки с колонками
+    FEED_COLUMNS) и курсор следующей страницы"""
+    rows = (
+        await session.execute(
+            search_page_query(query=query, limit=limit, cursor=cursor)
+        )
+    ).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].rank, rows[-1].id)
+    return rows, next_cursor
+
+
+def decode_id_cursor(cursor: str) -> int:
+    """Распаковывает курсор страницы, упорядоченной по id, в id"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        (tweet_id,) = json.loads(raw)
+    except (ValueError, TypeError):
+        raise CursorError(name="Некорректный курсор")
+
+    if type(tweet_id) is not int:
+        raise CursorError(name="Некорректный курсор")
+    return tweet_id
+
+
+def user_tweets_query(
+    author: UserIdentity, limit: int, cursor: str | None = None
+) -> Select:
+    """Запрос страницы твитов автора (колонки FEED_COLUMNS), limit + 1
+    строк, от новых к старым по индексу ix_tweets_user_id_id. Имя
+    автора известно заранее и подставляется литералом, без join users"""
+    query = (
+        select(
+            TweetsDB.id,
+            TweetsDB.tweet_data,
+            TweetsDB.tweet_media_ids,
+            TweetsDB.user_id,
+            literal(author.name).label("author_name"),
+        )
+        .where(TweetsDB.user_id == author.id)
+        .order_by(TweetsDB.id.desc())
+        .limit(limit + 1)
+    )
+    if cursor:
+        query = query.where(TweetsDB.id < decode_id_cursor(cursor))
+    return query
+
+
+async def get_user_tweets(
+    session: AsyncSession,
+    user_id: int,
+    limit: int,
+    cursor: str | None = None,
+) -> tuple[list[Row], str | None] | None:
+    """Возвращает страницу твитов пользователя и курсор следующей
+    страницы или None, если пользователя нет. Автор читается из БД
+    один раз на страницу"""
+    row = (
+        await session.execute(
+            select(UsersDB.id, UsersDB.name).where(UsersDB.id == user_id)
+        )
+    ).first()
+    if not row:
+        return None
+
+    query = user_tweets_query(
+        author=UserIdentity(*row), limit=limit, cursor=cursor
+    )
+    rows = (await session.execute(query)).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].id)
+    return rows, next_cursor
+
+
+async def get_likes(
+    tweet_ids: list[int], session: AsyncSession
+) -> dict[int, list[dict]]:
+    """Возвращает лайки твитов одним запросом: {tweet_id: [{user_id, name}]}"""
+    likes: dict[int, list[dict]] = {tweet_id: [] for tweet_id in tweet_ids}
+    if not tweet_ids:
+        return likes
+
+    rows = await session.execute(
+        select(LikesDB.tweet_id, UsersDB.id, UsersDB.name)
+        .join(UsersDB, UsersDB.id == LikesDB.user_id)
+        .where(LikesDB.tweet_id.in_(tweet_ids))
+        .order_by(LikesDB.tweet_id, UsersDB.id)
+    )
+    for tweet_id, user_id, name in rows:
+        likes[tweet_id].append({"user_id": user_id, "name": name})
+    return likes
+
+
+def like_count_change(changed: CTE, delta: int, update_count: bool) -> CTE:
+    """id твитов, где лайк поставлен или убран (changed - CTE
+    с tweet_id), при update_count like_count этих твитов меняется
+    на delta в том же запросе"""
+    if not update_count:
+        return select(changed.c.tweet_id.label("id")).cte("updated")
+    return (
+        update(TweetsDB)
+        .where(TweetsDB.id.in_(select(changed.c.tweet_id)))
+        .values(like_count=TweetsDB.like_count + delta)
+        .returning(TweetsDB.id)
+        .cte("updated")
+    )
+
+
+async def add_like(
+    tweet_id: int,
+    user_id: int,
+    session: AsyncSession,
+    update_count: bool = True,
+) -> bool:
+    """Ставит лайк одним запросом. Повторный лайк ничего не меняет,
+    счетчик like_count увеличивается только при вставке новой строки
+    (update_count=False - счетчик обновит app.counters). Возвращает
+    True, если лайк поставлен сейчас"""
+    inserted = (
+        insert(LikesDB)
+        .from_select(
+            ["tweet_id", "user_id"],
+            select(TweetsDB.id, literal(user_id)).where(
+                TweetsDB.id == tweet_id
+            ),
+        )
+        .on_conflict_do_nothing()
+        .returning(LikesDB.tweet_id)
+        .cte("inserted")
+    )
+    updated = like_count_change(inserted, 1, update_count)
+    return await session.scalar(select(updated.c.id)) is not None
+
+
+async def remove_like(
+    tweet_id: int,
+    user_id: int,
+    session: AsyncSession,
+    update_count: bool = True,
+) -> bool:
+    """Убирает лайк одним запросом, like_count уменьшается только
+    если лайк действительно был удален (update_count=False - счетчик
+    обновит app.counters). Возвращает True, если лайк был удален"""
+    deleted = (
+        delete(LikesDB)
+        .where(LikesDB.tweet_id == tweet_id, LikesDB.user_id == user_id)
+        .returning(LikesDB.tweet_id)
+        .cte("deleted")
+    )
+    updated = like_count_change(deleted, -1, update_count)
+    return await session.scalar(select(updated.c.id)) is not None
+
+
+async def add_likes(
+    tweet_ids: list[int],
+    user_id: int,
+    session: AsyncSession,
+    update_count: bool = True,
+) -> dict[int, bool]:
+    """Ставит лайки нескольким твитам одним запросом. Возвращает
+    {tweet_id: True, если лайк поставлен сейчас} для существующих твитов"""
+    inserted = (
+        insert(LikesDB)
+        .from_select(
+            ["tweet_id", "user_id"],
+            select(TweetsDB.id, literal(user_id)).where(
+                TweetsDB.id.in_(tweet_ids)
+            ),
+        )
+        .on_conflict_do_nothing()
+        .returning(LikesDB.tweet_id)
+        .cte("inserted")
+    )
+    updated = like_count_change(inserted, 1, update_count)
+    rows = await session.execute(
+        select(TweetsDB.id, TweetsDB.id.in_(select(updated.c.id))).where(
+            TweetsDB.id.in_(tweet_ids)
+        )
+    )
+    return dict(rows.tuples().all())
+
+
+async def remove_likes(
+    tweet_ids: list[int],
+    user_id: int,
+    session: AsyncSession,
+    update_count: bool = True,
+) -> dict[int, bool]:
+    """Убирает лайки с нескольких твитов одним запросом. Возвращает
+    {tweet_id: True, если лайк был удален} для существующих твитов"""
+    deleted = (
+        delete(LikesDB)
+        .where(LikesDB.tweet_id.in_(tweet_ids), LikesDB.user_id == user_id)
+        .returning(LikesDB.tweet_id)
+        .cte("deleted")
+    )
+    updated = like_count_change(deleted, -1, update_count)
+    rows = await session.execute(
+        select(TweetsDB.id, TweetsDB.id.in_(select(updated.c.id))).where(
+            TweetsDB.id.in_(tweet_ids)
+        )
+    )
+    return dict(rows.tuples().all())
+
+
+async def add_tweets(
+    tweets: list[TweetIn], user_id: int, session: AsyncSession
+) -> list[int]:
+    """Добавляет несколько твитов одним INSERT ... RETURNING,
+    id возвращаются в порядке твитов"""
+    if not tweets:
+        return []
+
+    tweet_ids = await session.scalars(
+        insert(TweetsDB).returning(TweetsDB.id, sort_by_parameter_order=True),
+        [
+            {
+                "tweet_data": tweet.tweet_data,
+                "tweet_media_ids": tweet.tweet_media_ids,
+                "user_id": user_id,
+            }
+            for tweet in tweets
+        ],
+    )
+    return list(tweet_ids)
+
+
+def user_counts_query() -> Select:
+    """Колонки UserOut: id, имя и счетчики подписчиков и подписок.
+    followers_count хранится в users, подписки считаются по первичному
+    ключу follows (index-only scan)"""
+    following_count = (
+        select(func.count())
+        .where(FollowsDB.follower_id == UsersDB.id)
+        .scalar_subquery()
+    )
+    return select(
+        UsersDB.id,
+        UsersDB.name,
+        UsersDB.followers_count,
+        following_count.label("following_count"),
+    )
+
+
+def follow_list(kind: str, viewer_id: int | None = None) -> Select:
+    """Первые FOLLOW_LIST_LIMIT подписчиков (kind="followers") или
+    подписок (kind="following") пользователя из внешнего запроса
+    по возрастанию id - JSON-массив [{id, name}]. Подписанный
+    пользователь viewer_id всегда попадает в список подписчиков вместо
+    последнего из первых FOLLOW_LIST_LIMIT: по нему фронтенд выбирает
+    кнопку подписки"""
+    if kind == "followers":
+        owner, other = FollowsDB.followee_id, FollowsDB.follower_id
+    else:
+        owner, other = FollowsDB.follower_id, FollowsDB.followee_id
+
+    member = aliased(UsersDB)
+    members_query = (
+        select(member.id, member.name)
+        .join(FollowsDB, other == member.id)
+        .where(owner == UsersDB.id)
+        .correlate(UsersDB)
+    )
+    members = members_query.order_by(other).limit(FOLLOW_LIST_LIMIT).subquery()
+    if kind == "followers" and viewer_id is not None:
+        # первые подписчики по индексу и строка viewer_id по первичному
+        # ключу follows, из не более FOLLOW_LIST_LIMIT + 1 строк
+        # отбрасывается последняя
+        candidates = union(
+            select(members),
+            members_query.where(other == viewer_id),
+        ).subquery()
+        members = (
+            select(candidates)
+            .order_by((candidates.c.id == viewer_id).desc(), candidates.c.id)
+            .limit(FOLLOW_LIST_LIMIT)
+            .subquery()
+        )
+    return select(
+        func.coalesce(
+            func.json_agg(
+                aggregate_order_by(
+                    func.json_build_object(
+                        "id", members.c.id, "name", members.c.name
+                    ),
+                    members.c.id,
+                )
+            ),
+            literal_column("'[]'::json"),
+            type_=JSON,
+        )
+    ).scalar_subquery()
+
+
+async def get_user_info(
+    user_id: int, session: AsyncSession, viewer_id: int | None = None
+) -> dict | None:
+    """Собирает данные для UserProfile одним запросом, None - если
+    пользователя нет. Списки followers/following прежнего формата
+    (не длиннее FOLLOW_LIST_LIMIT, подписанный viewer_id - всегда
+    в followers) читает собранный фронтенд, точное число подписчиков
+    и подписок - в followers_count и following_count"""
+    query = user_counts_query().where(UsersDB.id == user_id)
+    if FOLLOW_LIST_LIMIT:
+        query = query.add_columns(
+            follow_list("followers", viewer_id).label("followers"),
+            follow_list("following").label("following"),
+        )
+    row = (await session.execute(query)).first()
+    if not row:
+        return None
+    user_info = row._asdict()
+    user_info.setdefault("followers", [])
+    user_info.setdefault("following", [])
+    return user_info
+
+
+async def get_users_info(
+    user_ids: list[int], session: AsyncSession
+) -> dict[int, dict]:
+    """Собирает данные для UserOut нескольких пользователей одним
+    запросом независимо от их числа"""
+    rows = await session.execute(
+        user_counts_query().where(UsersDB.id.in_(user_ids))
+    )
+    return {row.id: row._asdict() for row in rows}
+
+
+def follows_page_query(
+    user_id: int, kind: str, limit: int, cursor: str | None = None
+) -> Select:
+    """Запрос страницы подписчиков (kind="followers") или подписок
+    (kind="following") пользователя по возрастанию id, limit + 1 строк.
+    Подписчики выбираются по индексу ix_follows_followee_follower,
+    подписки - по первичному ключу follows"""
+    if kind == "followers":
+        owner, other = FollowsDB.followee_id, FollowsDB.follower_id
+    else:
+        owner, other = FollowsDB.follower_id, FollowsDB.followee_id
+
+    query = (
+        select(UsersDB.id, UsersDB.name)
+        .join(FollowsDB, other == UsersDB.id)
+        .where(owner == user_id)
+        .order_by(other)
+        .limit(limit + 1)
+    )
+    if cursor:
+        query = query.where(other > decode_id_cursor(cursor))
+    return query
+
+
+async def get_follows_page(
+    session: AsyncSession,
+    user_id: int,
+    kind: str,
+    limit: int,
+    cursor: str | None = None,
+) -> tuple[list[dict], str | None] | None:
+    """Возвращает страницу подписчиков или подписок пользователя
+    ([{id, name}]) и курсор следующей страницы или None,
+    если пользователя нет"""
+    exists = await session.scalar(
+        select(UsersDB.id).where(UsersDB.id == user_id)
+    )
+    if exists is None:
+        return None
+
+    query = follows_page_query(
+        user_id=user_id, kind=kind, limit=limit, cursor=cursor
+    )
+    rows = (await session.execute(query)).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].id)
+    return [row._asdict() for row in rows], next_cursor
+
+
+async def get_followed_ids(
+    follower_id: int, user_ids: list[int], session: AsyncSession
+) -> set[int]:
+    """Из user_ids выбирает тех, на кого подписан follower_id,
+    одним запросом по первичному ключу follows"""
+    rows = await session.scalars(
+        select(FollowsDB.followee_id).where(
+            FollowsDB.follower_id == follower_id,
+            FollowsDB.followee_id.in_(user_ids),
+        )
+    )
+    return set(rows)
+
+
+async def follow(
+    follower_id: int, followee_id: int, session: AsyncSession
+) -> bool:
+    """Подписывает пользователя на другого одним запросом и увеличивает
+    followers_count автора. Повторная подписка ничего не меняет,
+    возвращает True, если подписка была создана"""
+    inserted = (
+        insert(FollowsDB)
+        .from_select(
+            ["follower_id", "followee_id"],
+            select(literal(follower_id), UsersDB.id).where(
+                UsersDB.id == followee_id
+            ),
+        )
+        .on_conflict_do_nothing()
+        .returning(FollowsDB.followee_id)
+        .cte("inserted")
+    )
+    result = await session.execute(
+        update(UsersDB)
+        .where(UsersDB.id.in_(select(inserted.c.followee_id)))
+        .values(followers_count=UsersDB.followers_count + 1)
+        .returning(UsersDB.id)
+        .execution_options(synchronize_session=False)
+    )
+    return result.scalar() is not None
+
+
+async def unfollow(
+    follower_id: int, followee_id: int, session: AsyncSession
+) -> bool:
+    """Отписывает пользователя от другого одним запросом и уменьшает
+    followers_count автора, возвращает True, если подписка была удалена"""
+    deleted = (
+        delete(FollowsDB)
+        .where(
+            FollowsDB.follower_id == follower_id,
+            FollowsDB.followee_id == followee_id,
+        )
+        .returning(FollowsDB.followee_id)
+        .cte("deleted")
+    )
+    result = await session.execute(
+        update(UsersDB)
+        .where(UsersDB.id.in_(select(deleted.c.followee_id)))
+        .values(followers_count=UsersDB.followers_count - 1)
+        .returning(UsersDB.id)
+        .execution_options(synchronize_session=False)
+    )
+    return result.scalar() is not None
@@ -0,0 +1,27 @@
+"""Настройки gunicorn: несколько процессов uvicorn (uvloop и httptools),
+gunicorn перезапускает упавшие и зависшие процессы и останавливает их
+плавно, дожидаясь текущих запросов.
+
+У каждого процесса свой пул соединений с БД (DB_POOL_SIZE +
+DB_MAX_OVERFLOW), локальные кэши и метрики. Миграции выполняются один
+раз до запуска процессов (см. Dockerfile).
+
+Запуск: gunicorn -c app/gunicorn.conf.py app.routes:app
+"""
+
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+# Число процессов, по умолчанию по числу ядер
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "uvicorn_worker.UvicornWorker"
+# Процесс, не отвечающий дольше timeout секунд, перезапускается
+timeout = int(os.environ.get("WORKER_TIMEOUT", 60))
+graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT", 30))
+# Соединения от nginx держатся дольше, чем их держит nginx (60 с),
+# чтобы соединение закрывал nginx, а не backend
+keepalive = int(os.environ.get("KEEPALIVE", 75))
+# Процессы перезапускаются по очереди после стольких запросов, 0 - никогда
+max_requests = int(os.environ.get("MAX_REQUESTS", 0))
+max_requests_jitter = max_requests // 10
@@ -0,0 +1,221 @@
+import asyncio
+import hashlib
+import logging
+import mimetypes
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+
+import aiofiles
+import aiofiles.os
+from fastapi import UploadFile
+from PIL import Image, ImageOps
+
+from app import config
+
+logger = logging.getLogger(__name__)
+
+# Размер блока, которым загружаемый файл пишется на диск
+CHUNK_SIZE = 256 * 1024
+# Изображение по id никогда не меняется, поэтому клиенты и прокси
+# могут кэшировать его без повторной проверки
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+FALLBACK_CACHE_CONTROL = "public, max-age=60"
+MEDIA_URL_PREFIX = "/api/medias/"
+
+
+class MediaTooLargeError(Exception):
+    """Исключение о том, что загружаемый файл больше MEDIA_MAX_SIZE"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.type = "MediaTooLargeError"
+
+
+class StoredFile(NamedTuple):
+    """Сохраненный на диск файл, filename - путь относительно MEDIA_ROOT"""
+
+    filename: str
+    sha256: str
+    size: int
+    content_type: str
+
+
+class Variant(NamedTuple):
+    """Уменьшенная копия изображения"""
+
+    size: str
+    filename: str
+    content_type: str
+    width: int
+    height: int
+
+
+def make_etag(
+    media_id: int,
+    sha256: str | None,
+    stat_result: os.stat_result,
+    size: str | None = None,
+) -> str:
+    """Строгий ETag изображения. Для изображений с хэшем это SHA-256
+    содержимого (и название копии), для загруженных до его появления -
+    id, размер и время записи файла, который после загрузки не изменяется"""
+    if sha256:
+        return f'"{sha256}-{size}"' if size else f'"{sha256}"'
+    return f'"{media_id}-{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"'
+
+
+def media_url(id_media: int) -> str:
+    """Ссылка на изображение для ленты, FEED_MEDIA_SIZE - какая копия"""
+    return f"{MEDIA_URL_PREFIX}{id_media}{media_url_query()}"
+
+
+def media_url_query() -> str:
+    return f"?size={config.FEED_MEDIA_SIZE}" if config.FEED_MEDIA_SIZE else ""
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """Проверяет заголовок If-None-Match (список ETag или "*")"""
+    if not if_none_match:
+        return False
+
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in (
+        tag.removeprefix("W/") for tag in candidates
+    )
+
+
+async def save_upload(file: UploadFile) -> StoredFile:
+    """Пишет загружаемый файл на диск блоками по CHUNK_SIZE, считая
+    SHA-256 на лету, и кладет его по пути из хэша: ab/cd/abcd....
+    Путь не зависит от имени файла у клиента, поэтому одинаковое
+    содержимое хранится в одном файле. Если такой файл уже есть,
+    новый не сохраняется"""
+    if file.size is not None and file.size > config.MEDIA_MAX_SIZE:
+        raise MediaTooLargeError(name="Файл слишком большой")
+
+    tmp_dir = os.path.join(config.MEDIA_ROOT, "tmp")
+    await aiofiles.os.makedirs(tmp_dir, exist_ok=True)
+    tmp_path = os.path.join(tmp_dir, uuid.uuid4().hex)
+
+    digest, size = hashlib.sha256(), 0
+    try:
+        async with aiofiles.open(tmp_path, "wb") as out_file:
+            while chunk := await file.read(CHUNK_SIZE):
+                size += len(chunk)
+                if size > config.MEDIA_MAX_SIZE:
+                    raise MediaTooLargeError(name="Файл слишком большой")
+                digest.update(chunk)
+                await out_file.write(chunk)
+
+        sha256 = digest.hexdigest()
+        filename = os.path.join(sha256[:2], sha256[2:4], sha256)
+        path = os.path.join(config.MEDIA_ROOT, filename)
+
+        if await aiofiles.os.path.exists(path):
+            await aiofiles.os.remove(tmp_path)
+        else:
+            await aiofiles.os.makedirs(os.path.dirname(path), exist_ok=True)
+            await aiofiles.os.replace(tmp_path, path)
+    except BaseException:
+        if await aiofiles.os.path.exists(tmp_path):
+            await aiofiles.os.remove(tmp_path)
+        raise
+
+    # тип определяется по расширению имени у клиента,
+    # отдаются только изображения
+    content_type = mimetypes.guess_type(file.filename or "")[0] or ""
+    if not content_type.startswith("image/"):
+        content_type = "application/octet-stream"
+
+    return StoredFile(
+        filename=filename, sha256=sha256, size=size, content_type=content_type
+    )
+
+
+def render_variants(
+    root: str, filename: str, sizes: dict[str, int], webp: bool
+) -> list[Variant]:
+    """Создает уменьшенные копии изображения рядом с оригиналом.
+    Выполняется в отдельном процессе, копии не больше оригинала
+    не создаются"""
+    base = os.path.splitext(filename)[0]
+    variants = []
+    with Image.open(os.path.join(root, filename)) as original:
+        image = ImageOps.exif_transpose(original)
+
+        for size, side in sorted(sizes.items(), key=lambda item: item[1]):
+            if max(image.size) <= side:
+                continue
+
+            variant = image.copy()
+            variant.thumbnail((side, side))
+            if webp:
+                image_format, extension = "WEBP", ".webp"
+            elif variant.mode in ("RGBA", "LA", "P"):
+                image_format, extension = "PNG", ".png"
+            else:
+                image_format, extension = "JPEG", ".jpg"
+            if image_format == "JPEG" and variant.mode != "RGB":
+                variant = variant.convert("RGB")
+
+            variant_filename = f"{base}.{size}{extension}"
+            variant.save(
+                os.path.join(root, variant_filename), image_format, quality=80
+            )
+            variants.append(
+                Variant(
+                    size=size,
+                    filename=variant_filename,
+                    content_type=Image.MIME[image_format],
+                    width=variant.width,
+                    height=variant.height,
+                )
+            )
+    return variants
+
+
+async def remove_media_file(filename: str, attempts: int = 3) -> bool:
+    """Удаляет файл из MEDIA_ROOT в пуле потоков, не блокируя event loop.
+    При ошибке повторяет попытку с растущей паузой"""
+    path = os.path.join(config.MEDIA_ROOT, filename)
+    for attempt in range(attempts):
+        try:
+            await aiofiles.os.remove(path)
+            return True
+        except FileNotFoundError:
+            return True
+        except OSError:
+            if attempt == attempts - 1:
+                logger.exception("Не удалось удалить файл %s", path)
+                return False
+            await asyncio.sleep(0.5 * 2**attempt)
+    return False
+
+
+process_pool: ProcessPoolExecutor | None = None
+
+
+async def make_variants(filename: str) -> list[Variant]:
+    """Создает уменьшенные копии изображения в пуле процессов,
+    не блокируя event loop"""
+    global process_pool
+    if process_pool is None:
+        process_pool = ProcessPoolExecutor(max_workers=config.MEDIA_WORKERS)
+
+    return await asyncio.get_running_loop().run_in_executor(
+        process_pool,
+        render_variants,
+        config.MEDIA_ROOT,
+        filename,
+        config.MEDIA_VARIANTS,
+        config.MEDIA_VARIANTS_WEBP,
+    )
+
+
+def shutdown_process_pool() -> None:
+    global process_pool
+    if process_pool is not None:
+        process_pool.shutdown()
+        process_pool = None
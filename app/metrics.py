@@ -0,0 +1,344 @@
+"""Метрики запросов в текстовом формате Prometheus (GET /metrics).
+
+MetricsMiddleware замеряет для каждого маршрута время ответа, размер
+запроса и ответа, а вместе с обработчиками событий движка
+(instrument_engine) - время в БД, число SQL-запросов и ожидание
+соединения из пула. Статистика текущего запроса хранится в contextvar,
+гистограммы - в памяти процесса (у каждого процесса свои).
+
+SLOW_QUERY_MS > 0 включает журнал медленных запросов: SQL и типы
+параметров (значения в журнал не попадают).
+"""
+
+import bisect
+import contextvars
+import logging
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import config
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+REQUEST_LABELS = ("method", "route")
+
+
+def format_labels(names: tuple[str, ...], values: tuple) -> str:
+    return ",".join(
+        f'{name}="{escape(str(value))}"' for name, value in zip(names, values)
+    )
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def series_name(name: str, labels: str) -> str:
+    return f"{name}{{{labels}}}" if labels else name
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.series: dict[tuple, float] = {} if labels else {(): 0}
+
+    def inc(self, labels: tuple = (), value: float = 1) -> None:
+        self.series[labels] = self.series.get(labels, 0) + value
+
+    def render(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} counter",
+        ]
+        for values, total in self.series.items():
+            labels = format_labels(self.labels, values)
+            lines.append(f"{series_name(self.name, labels)} {total}")
+        return lines
+
+
+class Histogram:
+    """Гистограмма: для каждого набора меток число значений в каждой
+    корзине (не накопленное), сумма и количество"""
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...],
+        buckets: tuple[float, ...],
+    ):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series: dict[tuple, list] = {}
+
+    def observe(self, labels: tuple, value: float) -> None:
+        series = self.series.get(labels)
+        if series is None:
+            # корзины, +Inf и сумма
+            series = self.series[labels] = [0] * (len(self.buckets) + 1)
+            series.append(0.0)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} histogram",
+        ]
+        bounds = [str(bucket) for bucket in self.buckets] + ["+Inf"]
+        for values, series in self.series.items():
+            labels = format_labels(self.labels, values)
+            prefix = f"{labels}," if labels else ""
+            cumulative = 0
+            for bound, count in zip(bounds, series):
+                cumulative += count
+                lines.append(
+                    f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}'
+                )
+            lines.append(
+                f"{series_name(self.name + '_sum', labels)} {series[-1]}"
+            )
+            lines.append(
+                f"{series_name(self.name + '_count', labels)} {cumulative}"
+            )
+        return lines
+
+
+request_duration = Histogram(
+    "http_request_duration_seconds",
+    "Время обработки запроса",
+    REQUEST_LABELS + ("status",),
+    LATENCY_BUCKETS,
+)
+db_duration = Histogram(
+    "http_request_db_duration_seconds",
+    "Время выполнения SQL-запросов за один HTTP-запрос",
+    REQUEST_LABELS,
+    LATENCY_BUCKETS,
+)
+db_statements = Histogram(
+    "http_request_db_statements",
+    "Число SQL-запросов за один HTTP-запрос",
+    REQUEST_LABELS,
+    STATEMENT_BUCKETS,
+)
+pool_wait = Histogram(
+    "http_request_db_pool_wait_seconds",
+    "Ожидание соединения из пула за один HTTP-запрос",
+    REQUEST_LABELS,
+    LATENCY_BUCKETS,
+)
+request_bytes = Counter(
+    "http_request_size_bytes_total",
+    "Получено байт тела запроса",
+    REQUEST_LABELS,
+)
+response_bytes = Counter(
+    "http_response_size_bytes_total",
+    "Отправлено байт тела ответа",
+    REQUEST_LABELS,
+)
+slow_queries = Counter(
+    "db_slow_queries_total", "SQL-запросы дольше SLOW_QUERY_MS"
+)
+outbox_events = Counter(
+    "outbox_events_dispatched_total",
+    "События outbox, разосланные подписчикам процесса",
+    ("event",),
+)
+feed_cache_requests = Counter(
+    "feed_cache_requests_total",
+    "Страницы ленты из кэша (hit), собранные из БД (miss) и без кэша "
+    "(bypass)",
+    ("result",),
+)
+
+METRICS = (
+    request_duration,
+    db_duration,
+    db_statements,
+    pool_wait,
+    request_bytes,
+    response_bytes,
+    slow_queries,
+    outbox_events,
+    feed_cache_requests,
+)
+
+
+class RequestStats:
+    """Статистика текущего HTTP-запроса"""
+
+    __slots__ = ("statements", "db_time", "pool_wait", "bytes_in", "bytes_out")
+
+    def __init__(self):
+        self.statements = 0
+        self.db_time = 0.0
+        self.pool_wait = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+
+current_request: contextvars.ContextVar[RequestStats | None] = (
+    contextvars.ContextVar("current_request", default=None)
+)
+
+
+def record_pool_wait(seconds: float) -> None:
+    """Добавляет ожидание соединения из пула к текущему запросу"""
+    stats = current_request.get()
+    if stats is not None:
+        stats.pool_wait += seconds
+
+
+def parameters_shape(parameters) -> str:
+    """Типы параметров SQL-запроса без значений: (int, str, list[3]),
+    для executemany - число наборов и форма первого"""
+    if isinstance(parameters, list):
+        if not parameters:
+            return "[]"
+        return f"{len(parameters)} x {parameters_shape(parameters[0])}"
+    if isinstance(parameters, dict):
+        items = ", ".join(
+            f"{name}: {value_shape(value)}"
+            for name, value in parameters.items()
+        )
+        return f"{{{items}}}"
+    if isinstance(parameters, tuple):
+        return f"({', '.join(value_shape(value) for value in parameters)})"
+    return type(parameters).__name__
+
+
+def value_shape(value) -> str:
+    if isinstance(value, (list, tuple)):
+        return f"{type(value).__name__}[{len(value)}]"
+    return type(value).__name__
+
+
+def before_cursor_execute(conn, cursor, statement, *args) -> None:
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def after_cursor_execute(
+    conn, cursor, statement, parameters, context, executemany
+) -> None:
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    stats = current_request.get()
+    if stats is not None:
+        stats.statements += 1
+        stats.db_time += elapsed
+
+    if config.SLOW_QUERY_MS and elapsed * 1000 >= config.SLOW_QUERY_MS:
+        slow_queries.inc()
+        logger.warning(
+            "Медленный запрос %.1f мс: %s; параметры: %s",
+            elapsed * 1000,
+            " ".join(statement.split()),
+            parameters_shape(parameters),
+        )
+
+
+def handle_error(context) -> None:
+    """Запрос с ошибкой тоже учитывается, время начала снимается
+    со стека"""
+    starts = (
+        context.connection.info.get("query_start")
+        if context.connection
+        else None
+    )
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    stats = current_request.get()
+    if stats is not None:
+        stats.statements += 1
+        stats.db_time += elapsed
+
+
+def instrument_engine(engine: Engine) -> None:
+    """Подключает замеры SQL-запросов к движку (повторно не подключает)"""
+    if event.contains(engine, "before_cursor_execute", before_cursor_execute):
+        return
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+    event.listen(engine, "handle_error", handle_error)
+
+
+class MetricsMiddleware:
+    """ASGI-middleware, которое замеряет каждый HTTP-запрос. Маршрут
+    берется из шаблона пути (/api/users/{user_id}), запросы без маршрута
+    попадают в "unmatched", чтобы число рядов не росло"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats = RequestStats()
+        status = 500
+
+        async def receive_counted():
+            message = await receive()
+            if message["type"] == "http.request":
+                stats.bytes_in += len(message.get("body", b""))
+            return message
+
+        async def send_counted(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                stats.bytes_out += len(message.get("body", b""))
+            await send(message)
+
+        token = current_request.set(stats)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive_counted, send_counted)
+        finally:
+            elapsed = time.perf_counter() - start
+            current_request.reset(token)
+            route = scope.get("route")
+            labels = (scope["method"], getattr(route, "path", "unmatched"))
+            request_duration.observe(labels + (status,), elapsed)
+            db_duration.observe(labels, stats.db_time)
+            db_statements.observe(labels, stats.statements)
+            pool_wait.observe(labels, stats.pool_wait)
+            request_bytes.inc(labels, stats.bytes_in)
+            response_bytes.inc(labels, stats.bytes_out)
+
+
+def render(gauges: dict[str, float]) -> str:
+    """Все метрики и переданные значения gauges в формате Prometheus"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    for name, value in gauges.items():
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
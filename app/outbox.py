@@ -0,0 +1,260 @@
+"""Транзакционный outbox: поток событий изменений.
+
+Обработчики записывают события (app.events: tweet_created, like_added,
+followed, ...) в таблицу outbox функцией record в той же транзакции,
+что и сами изменения, поэтому событие появляется тогда и только тогда,
+когда изменения зафиксированы. Диспетчер каждого процесса читает новые
+события по возрастанию id и передает их пачками подписчикам процесса
+(декоратор on) и клиентам GET /api/events/stream (Server-Sent Events).
+
+id выдаются при вставке, а транзакции фиксируются в другом порядке,
+поэтому диспетчер не проходит пропуск в id, пока не истечет
+OUTBOX_GAP_TIMEOUT: за это время транзакция с меньшим id успевает
+зафиксироваться, иначе пропуск остался от откаченной транзакции.
+
+events.emit по-прежнему вызывается сразу после фиксации в процессе,
+выполнившем запрос, события outbox получают все процессы с задержкой
+до OUTBOX_POLL_INTERVAL.
+"""
+
+import asyncio
+import logging
+import time
+from datetime import timedelta
+from typing import AsyncIterator, Awaitable, Callable, NamedTuple
+
+import orjson
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from app import config, metrics
+from app.db_models import OutboxDB
+
+logger = logging.getLogger(__name__)
+
+# Сколько событий ждет отправки одному клиенту потока, медленный клиент
+# отключается и переподключается с Last-Event-ID
+STREAM_QUEUE_SIZE = 1000
+# Комментарий в поток, если событий нет столько секунд
+STREAM_KEEPALIVE = 15
+CLEANUP_INTERVAL = 60
+
+
+class OutboxEvent(NamedTuple):
+    id: int
+    event: str
+    payload: dict
+
+    def sse(self) -> bytes:
+        """Событие в формате text/event-stream"""
+        return (
+            f"id: {self.id}\nevent: {self.event}\ndata: ".encode()
+            + orjson.dumps(self.payload)
+            + b"\n\n"
+        )
+
+
+BatchHandler = Callable[[list[OutboxEvent]], Awaitable[None]]
+
+handlers: list[tuple[frozenset[str], BatchHandler]] = []
+
+
+def on(*events: str) -> Callable[[BatchHandler], BatchHandler]:
+    """Декоратор, подписывает функцию на пачки событий outbox:
+    функция получает события пачки с перечисленными именами"""
+
+    def decorator(handler: BatchHandler) -> BatchHandler:
+        handlers.append((frozenset(events), handler))
+        return handler
+
+    return decorator
+
+
+async def record(session: AsyncSession, event: str, **payload) -> None:
+    """Записывает событие в outbox в транзакции session"""
+    if config.OUTBOX_ENABLED:
+        await session.execute(
+            insert(OutboxDB).values(event=event, payload=payload)
+        )
+
+
+async def read_events(
+    session: AsyncSession, after_id: int, limit: int
+) -> list[OutboxEvent]:
+    rows = await session.execute(
+        select(OutboxDB.id, OutboxDB.event, OutboxDB.payload)
+        .where(OutboxDB.id > after_id)
+        .order_by(OutboxDB.id)
+        .limit(limit)
+    )
+    return [OutboxEvent(*row) for row in rows]
+
+
+class Subscription:
+    """Очередь событий одного клиента потока"""
+
+    def __init__(self):
+        self.queue: asyncio.Queue[OutboxEvent | None] = asyncio.Queue(
+            maxsize=STREAM_QUEUE_SIZE
+        )
+        self.closed = False
+
+    def close(self) -> None:
+        self.closed = True
+        try:
+            self.queue.put_nowait(None)
+        except asyncio.QueueFull:
+            pass
+
+
+class Dispatcher:
+    def __init__(self):
+        # id последнего разосланного события, None - диспетчер
+        # еще не читал outbox
+        self.last_id: int | None = None
+        self.gap_since: float | None = None
+        self.subscriptions: set[Subscription] = set()
+        self.task: asyncio.Task | None = None
+        self.cleaned_at = 0.0
+
+    def contiguous(self, rows: list[OutboxEvent]) -> list[OutboxEvent]:
+        """Начало rows без пропусков в id, пропуск проходится после
+        OUTBOX_GAP_TIMEOUT"""
+        batch = []
+        expected = self.last_id + 1
+        for row in rows:
+            if row.id != expected:
+                now = time.monotonic()
+                if self.gap_since is None:
+                    self.gap_since = now
+                if now - self.gap_since < config.OUTBOX_GAP_TIMEOUT:
+                    break
+            self.gap_since = None
+            batch.append(row)
+            expected = row.id + 1
+        return batch
+
+    async def poll(self, async_session: async_sessionmaker) -> int:
+        """Читает и рассылает следующую пачку событий, возвращает
+        число прочитанных строк. Первый вызов только запоминает
+        последний id: рассылаются события, записанные после запуска"""
+        async with async_session() as session:
+            if self.last_id is None:
+                self.last_id = await session.scalar(
+                    select(func.coalesce(func.max(OutboxDB.id), 0))
+                )
+                return 0
+            rows = await read_events(
+                session, after_id=self.last_id, limit=config.OUTBOX_BATCH_SIZE
+            )
+
+        batch = self.contiguous(rows)
+        if batch:
+            self.last_id = batch[-1].id
+            await self.dispatch(batch)
+        return len(rows)
+
+    async def dispatch(self, batch: list[OutboxEvent]) -> None:
+        for event in batch:
+            metrics.outbox_events.inc((event.event,))
+
+        for events, handler in handlers:
+            matching = [event for event in batch if event.event in events]
+            if not matching:
+                continue
+            try:
+                await handler(matching)
+            except Exception:
+                logger.exception("Ошибка подписчика outbox %s", handler)
+
+        for subscription in list(self.subscriptions):
+            try:
+                for event in batch:
+                    subscription.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self.subscriptions.discard(subscription)
+                subscription.closed = True
+
+    async def cleanup(self, async_session: async_sessionmaker) -> None:
+        """Удаляет события старше OUTBOX_RETENTION_HOURS"""
+        retention = timedelta(hours=config.OUTBOX_RETENTION_HOURS)
+        async with async_session() as session:
+            await session.execute(
+                delete(OutboxDB).where(
+                    OutboxDB.created_at < func.now() - retention
+                )
+            )
+            await session.commit()
+
+    async def run(self, async_session: async_sessionmaker) -> None:
+        while True:
+            try:
+                count = await self.poll(async_session)
+                if time.monotonic() - self.cleaned_at > CLEANUP_INTERVAL:
+                    self.cleaned_at = time.monotonic()
+                    await self.cleanup(async_session)
+            except Exception:
+                logger.exception("Не удалось прочитать outbox")
+                count = 0
+            if count < config.OUTBOX_BATCH_SIZE:
+                await asyncio.sleep(config.OUTBOX_POLL_INTERVAL)
+
+    def start(self, async_session: async_sessionmaker) -> None:
+        self.task = asyncio.create_task(self.run(async_session))
+
+    def stop(self) -> None:
+        """Останавливает чтение outbox и закрывает потоки клиентов"""
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        for subscription in self.subscriptions:
+            subscription.close()
+        self.subscriptions.clear()
+
+    async def stream(
+        self, async_session: async_sessionmaker, after_id: int | None
+    ) -> AsyncIterator[bytes]:
+        """Поток событий для клиента: сначала события после after_id
+        (Last-Event-ID) из таблицы, затем новые от диспетчера"""
+        subscription = Subscription()
+        self.subscriptions.add(subscription)
+        try:
+            last = after_id or 0
+            # пока диспетчер не прочитал outbox (процесс только запущен),
+            # неизвестно, какие события придут от него, а какие отдавать
+            # из таблицы
+            while after_id is not None and self.last_id is None:
+                await asyncio.sleep(config.OUTBOX_POLL_INTERVAL)
+            while after_id is not None:
+                async with async_session() as session:
+                    rows = await read_events(
+                        session, after_id=last, limit=config.OUTBOX_BATCH_SIZE
+                    )
+                # более новые события придут от диспетчера
+                rows = [row for row in rows if row.id <= self.last_id]
+                for row in rows:
+                    yield row.sse()
+                    last = row.id
+                if len(rows) < config.OUTBOX_BATCH_SIZE:
+                    break
+
+            while True:
+                try:
+                    event = await asyncio.wait_for(
+                        subscription.queue.get(), STREAM_KEEPALIVE
+                    )
+                except asyncio.TimeoutError:
+                    if subscription.closed:
+                        return
+                    yield b": keepalive\n\n"
+                    continue
+                if event is None:
+                    return
+                if event.id > last:
+                    yield event.sse()
+                    last = event.id
+        finally:
+            self.subscriptions.discard(subscription)
+
+
+dispatcher = Dispatcher()
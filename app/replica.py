@@ -0,0 +1,153 @@
+"""Чтение с реплики БД (DATABASE_REPLICA_URL).
+
+Эндпоинты чтения получают фабрику сессий через get_read_session
+(routes.py): сессии на реплике, если она настроена и доступна, иначе
+на основной БД. Соединение с репликой берется при открытии сессии,
+если подключиться не удалось, сессия открывается на основной БД, а
+реплика REPLICA_RETRY_SECONDS секунд не используется.
+
+Чтение своих изменений: после любого изменяющего запроса (не GET/HEAD)
+пользователь REPLICA_STICKY_SECONDS секунд читает с основной БД. Это
+запоминается по Api-Key в процессе и в cookie, по которой остальные
+процессы приложения тоже отправляют его запросы на основную БД.
+"""
+
+import logging
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from fastapi import Request
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import (
+    AsyncConnection,
+    AsyncEngine,
+    AsyncSession,
+    async_sessionmaker,
+)
+
+from app import config
+from app.cache import TTLCache
+from app.database import engine_replica
+
+logger = logging.getLogger(__name__)
+
+STICKY_COOKIE = "read_primary"
+SAFE_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+
+class ReplicaRouter:
+    def __init__(
+        self,
+        engine: AsyncEngine | None,
+        sticky_seconds: float,
+        retry_seconds: float,
+    ):
+        self.engine = engine
+        self.sticky_seconds = sticky_seconds
+        self.retry_seconds = retry_seconds
+        self.writers = TTLCache(
+            maxsize=config.AUTH_CACHE_SIZE, ttl=sticky_seconds
+        )
+        self.down_until = 0.0
+
+    def mark_write(self, api_key: str | None) -> None:
+        if api_key:
+            self.writers.set(api_key, True)
+
+    def use_replica(self, request: Request) -> bool:
+        """Можно ли читать с реплики для этого запроса"""
+        if self.engine is None or time.monotonic() < self.down_until:
+            return False
+        if STICKY_COOKIE in request.cookies:
+            return False
+        api_key = request.headers.get("Api-Key")
+        return not (api_key and self.writers.get(api_key))
+
+    def sessions(
+        self, request: Request, primary: async_sessionmaker
+    ) -> "async_sessionmaker | ReadSessions":
+        """Фабрика сессий для чтения в этом запросе"""
+        if not self.use_replica(request):
+            return primary
+        return ReadSessions(router=self, primary=primary)
+
+    async def connect(self) -> AsyncConnection | None:
+        """Соединение с репликой или None, если она недоступна"""
+        try:
+            return await self.engine.connect()
+        except (OSError, SQLAlchemyError) as exc:
+            self.down_until = time.monotonic() + self.retry_seconds
+            logger.warning(
+                "Реплика недоступна (%s), %s с чтения идут в основную БД",
+                exc,
+                self.retry_seconds,
+            )
+            return None
+
+
+class ReadSessions:
+    """Фабрика сессий на реплике, используется как async_sessionmaker:
+    async with async_session() as session: ..."""
+
+    def __init__(self, router: ReplicaRouter, primary: async_sessionmaker):
+        self.router = router
+        self.primary = primary
+
+    @asynccontextmanager
+    async def __call__(self) -> AsyncIterator[AsyncSession]:
+        connection = await self.router.connect()
+        if connection is None:
+            async with self.primary() as session:
+                yield session
+            return
+
+        try:
+            async with AsyncSession(
+                bind=connection, expire_on_commit=False
+            ) as session:
+                yield session
+        finally:
+            await connection.close()
+
+
+class StickyWritesMiddleware:
+    """ASGI-middleware, которое после изменяющих запросов отправляет
+    чтение пользователя на основную БД"""
+
+    def __init__(self, app, router: ReplicaRouter):
+        self.app = app
+        self.router = router
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or self.router.engine is None
+            or scope["method"] in SAFE_METHODS
+        ):
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope["headers"])
+        self.router.mark_write(headers.get(b"api-key", b"").decode())
+        cookie = (
+            f"{STICKY_COOKIE}=1; "
+            f"Max-Age={math.ceil(self.router.sticky_seconds)}; "
+            "Path=/; HttpOnly; SameSite=Lax"
+        )
+
+        async def send_with_cookie(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"set-cookie", cookie.encode())
+                ]
+            await send(message)
+
+        await self.app(scope, receive, send_with_cookie)
+
+
+replica_router = ReplicaRouter(
+    engine=engine_replica,
+    sticky_seconds=config.REPLICA_STICKY_SECONDS,
+    retry_seconds=config.REPLICA_RETRY_SECONDS,
+)
@@ -1,49 +1,163 @@
+import asyncio
+import mimetypes
 import os
-import random
 from contextlib import asynccontextmanager
-from typing import Optional, Union
+from typing import Literal
 
 import aiofiles
-from fastapi import FastAPI, Request, UploadFile, Response, Depends
-from fastapi.responses import JSONResponse
-from sqlalchemy import select, delete, update, func
+import aiofiles.os
+from fastapi import (
+    FastAPI,
+    Request,
+    UploadFile,
+    Response,
+    Depends,
+    Query,
+    Header,
+    BackgroundTasks,
+)
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.asyncio import async_sessionmaker
 
-from app.database import engine_async
-from app.db_models import Base, UsersDB, TweetsDB, MediaDB
-from app.functions import get_user, del_media, get_tweet, get_media
+from app import config, events, metrics, outbox
+from app.config import (
+    BATCH_MAX_SIZE,
+    FEED_PAGE_SIZE,
+    FEED_MAX_PAGE_SIZE,
+    FOLLOW_PAGE_SIZE,
+    FOLLOW_MAX_PAGE_SIZE,
+)
+from app.database import (
+    async_session,
+    engine_async,
+    engine_replica,
+    pool_status,
+)
+from app.db_models import TweetsDB
+from app.media import (
+    CACHE_CONTROL,
+    FALLBACK_CACHE_CONTROL,
+    make_etag,
+    etag_matches,
+    save_upload,
+    shutdown_process_pool,
+    MediaTooLargeError,
+)
+from app.counters import counter_buffer, LIKES, VIEWS
+from app.feed_cache import feed_cache
+from app.replica import replica_router, StickyWritesMiddleware
+from app.serializers import feed_page_json, feed_page_envelope, respond
+from app.functions import (
+    get_user_identity,
+    delete_tweet,
+    cleanup_media_files,
+    create_user,
+    UserIdentity,
+    get_media,
+    get_media_variant,
+    add_media,
+    process_media,
+    get_feed_page,
+    get_followee_ids,
+    feed_page_query,
+    get_feed_json_page,
+    get_likes,
+    add_like,
+    remove_like,
+    add_likes,
+    remove_likes,
+    add_tweets,
+    add_tweet_tags,
+    search_tweets,
+    get_user_tweets,
+    get_user_info,
+    get_users_info,
+    get_follows_page,
+    get_followed_ids,
+    follow,
+    unfollow,
+    CursorError,
+)
+from app.timeline import (
+    fan_out_tweet,
+    fan_out_tweets,
+    add_author_tweets,
+    remove_author_tweets,
+    fan_out_resumed,
+    backfill_author_tweets,
+    get_timeline_page,
+    timeline_page_query,
+)
 from app.routes_models import (
     UserOut,
     TweetOut,
     TweetIn,
     Result,
     TweetsBand,
-    TweetsForBand,
-    Author,
-    Likes,
-    Following,
-    Followers,
     Medias,
+    PoolStatus,
+    UserIds,
+    UsersBatch,
+    TweetsIn,
+    TweetsBatch,
+    TweetIds,
+    LikeItem,
+    LikesBatch,
+    FollowsPage,
+    FollowsCheck,
 )
 
 
-async def create_db():
-    async with engine_async.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+def get_session() -> async_sessionmaker:
+    return async_session
 
 
-def get_session() -> async_sessionmaker:
-    return async_sessionmaker(bind=engine_async, expire_on_commit=False)
+def get_read_session(
+    request: Request, async_session: async_sessionmaker = Depends(get_session)
+) -> async_sessionmaker:
+    """Фабрика сессий только для чтения: на реплике, если она настроена
+    и пользователь недавно ничего не менял, иначе на основной БД"""
+    return replica_router.sessions(request=request, primary=async_session)
+
+
+async def get_current_user(
+    request: Request, async_session: async_sessionmaker = Depends(get_session)
+) -> UserIdentity | None:
+    """Возвращает пользователя по header Api-Key (id и имя, без связанных
+    объектов), повторные запросы обслуживаются из кэша"""
+    username = request.headers.get("Api-Key")
+    if not username:
+        return None
+
+    async with async_session() as session:
+        return await get_user_identity(username=username, session=session)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    await create_db()
+    # схема БД создается и обновляется миграциями:
+    # alembic -c app/alembic.ini upgrade head
+    counter_buffer.start(async_session)
+    if config.OUTBOX_ENABLED:
+        outbox.dispatcher.start(async_session)
     yield
+    outbox.dispatcher.stop()
+    await counter_buffer.stop(async_session)
+    shutdown_process_pool()
 
 
 app = FastAPI(lifespan=lifespan)
 
+app.add_middleware(StickyWritesMiddleware, router=replica_router)
+
+if config.METRICS_ENABLED:
+    app.add_middleware(metrics.MetricsMiddleware)
+    metrics.instrument_engine(engine_async.sync_engine)
+    if engine_replica is not None:
+        metrics.instrument_engine(engine_replica.sync_engine)
+
 
 @app.get("/api/users/me")
 async def func_1(
@@ -54,146 +168,421 @@ async def func_1(
     api_key = request.headers.get("Api-Key")
 
     async with async_session() as session:
-        user_info = await get_user(username=api_key, session=session)
-        if not user_info:
-            user_info = UsersDB(name=api_key, followers=[], following=[])
-            session.add(user_info)
+        user = await get_user_identity(username=api_key, session=session)
+        if not user:
+            user = await create_user(username=api_key, session=session)
             await session.commit()
 
-    user = UserOut(user=user_info.to_dict())
-    return user
+        user_info = await get_user_info(user_id=user.id, session=session)
+
+    return respond(UserOut, user=user_info)
+
+
+@app.get("/api/users/me/follows")
+async def func_26(
+    ids: list[int] = Query(min_length=1, max_length=BATCH_MAX_SIZE),
+    user: UserIdentity | None = Depends(get_current_user),
+    async_session: async_sessionmaker = Depends(get_read_session),
+) -> FollowsCheck | None:
+    """Подписан ли текущий пользователь на пользователей из ids
+    (?ids=1&ids=2), для кнопок подписки без загрузки списков"""
+    if not user:
+        return None
+
+    user_ids = list(dict.fromkeys(ids))
+    async with async_session() as session:
+        followed = await get_followed_ids(
+            follower_id=user.id, user_ids=user_ids, session=session
+        )
+
+    return respond(
+        FollowsCheck,
+        users=[
+            {"id": user_id, "following": user_id in followed}
+            for user_id in user_ids
+        ],
+    )
 
 
 @app.get("/api/users/{user_id}")
 async def func_2(
-    user_id: int, async_session: async_sessionmaker = Depends(get_session)
+    user_id: int,
+    user: UserIdentity | None = Depends(get_current_user),
+    async_session: async_sessionmaker = Depends(get_read_session),
 ) -> UserOut | None:
-    """Получить пользователя по его id"""
+    """Получить пользователя по его id, текущий пользователь, если
+    подписан, всегда есть в списке followers"""
+    async with async_session() as session:
+        user_info = await get_user_info(
+            user_id=user_id,
+            session=session,
+            viewer_id=user.id if user else None,
+        )
+
+    if not user_info:
+        return None
+
+    return respond(UserOut, user=user_info)
+
+
+async def follows_page(
+    user_id: int,
+    kind: str,
+    limit: int,
+    cursor: str | None,
+    async_session: async_sessionmaker,
+) -> FollowsPage | None:
+    """Страница подписчиков или подписок пользователя,
+    None - если пользователя нет"""
+    async with async_session() as session:
+        page = await get_follows_page(
+            session=session,
+            user_id=user_id,
+            kind=kind,
+            limit=limit,
+            cursor=cursor,
+        )
+
+    if page is None:
+        return None
+
+    users, next_cursor = page
+    if next_cursor is None:
+        return respond(FollowsPage, users=users)
+    return respond(FollowsPage, users=users, next_cursor=next_cursor)
+
+
+@app.get(
+    "/api/users/{user_id}/followers",
+    response_model=FollowsPage | None,
+    response_model_exclude_none=True,
+)
+async def func_27(
+    user_id: int,
+    limit: int = Query(
+        default=FOLLOW_PAGE_SIZE, ge=1, le=FOLLOW_MAX_PAGE_SIZE
+    ),
+    cursor: str | None = None,
+    async_session: async_sessionmaker = Depends(get_read_session),
+) -> FollowsPage | None:
+    """Подписчики пользователя по возрастанию id, next_cursor указывает
+    на следующую страницу"""
+    return await follows_page(
+        user_id=user_id,
+        kind="followers",
+        limit=limit,
+        cursor=cursor,
+        async_session=async_session,
+    )
+
+
+@app.get(
+    "/api/users/{user_id}/following",
+    response_model=FollowsPage | None,
+    response_model_exclude_none=True,
+)
+async def func_28(
+    user_id: int,
+    limit: int = Query(
+        default=FOLLOW_PAGE_SIZE, ge=1, le=FOLLOW_MAX_PAGE_SIZE
+    ),
+    cursor: str | None = None,
+    async_session: async_sessionmaker = Depends(get_read_session),
+) -> FollowsPage | None:
+    """Подписки пользователя по возрастанию id, next_cursor указывает
+    на следующую страницу"""
+    return await follows_page(
+        user_id=user_id,
+        kind="following",
+        limit=limit,
+        cursor=cursor,
+        async_session=async_session,
+    )
+
+
+@app.get(
+    "/api/users/{user_id}/tweets",
+    response_model=TweetsBand | None,
+    response_model_exclude_none=True,
+)
+async def func_25(
+    user_id: int,
+    limit: int = Query(default=FEED_PAGE_SIZE, ge=1, le=FEED_MAX_PAGE_SIZE),
+    cursor: str | None = None,
+    async_session: async_sessionmaker = Depends(get_read_session),
+) -> Response | None:
+    """Твиты пользователя от новых к старым, next_cursor указывает
+    на следующую страницу"""
     async with async_session() as session:
-        user = await get_user(session=session, user_id=user_id)
+        page = await get_user_tweets(
+            session=session, user_id=user_id, limit=limit, cursor=cursor
+        )
+        if page is None:
+            return None
+
+        tweets, next_cursor = page
+        likes = await get_likes(
+            tweet_ids=[tweet.id for tweet in tweets], session=session
+        )
 
-    return UserOut(user=user.to_dict()) if user else None
+    return Response(
+        content=feed_page_json(
+            tweets=tweets, likes=likes, next_cursor=next_cursor
+        ),
+        media_type="application/json",
+    )
 
 
 @app.post("/api/tweets", status_code=201)
 async def func_3(
-    request: Request,
     tweet: TweetIn,
+    user: UserIdentity | None = Depends(get_current_user),
     async_session: async_sessionmaker = Depends(get_session),
 ) -> TweetOut | None:
     """Добавляет твит в БД"""
-    username = request.headers.get("Api-Key")
+    if not user:
+        return None
 
     async with async_session() as session:
-        user = await get_user(username=username, session=session)
-
-        if not user:
-            return None
 
         tw = TweetsDB(
             tweet_data=tweet.tweet_data,
             tweet_media_ids=tweet.tweet_media_ids,
             user_id=user.id,
-            likes=[],
         )
-        await session.refresh(user)
-        user.tweets.append(tw)
+        session.add(tw)
+        await session.flush()
+        await add_tweet_tags(tweets={tw.id: tw.tweet_data}, session=session)
+
+        if config.TIMELINE_MODE == "push":
+            await fan_out_tweet(
+                tweet_id=tw.id, author_id=user.id, session=session
+            )
+        await outbox.record(
+            session, events.TWEET_CREATED, user_id=user.id, tweet_ids=[tw.id]
+        )
         await session.commit()
 
-    return TweetOut(tweet_id=user.tweets[-1].id) if user else None
+    await events.emit(events.TWEET_CREATED, user_id=user.id, tweet_ids=[tw.id])
 
+    return TweetOut(tweet_id=tw.id)
 
-@app.get("/api/tweets")
-async def func_4(
-    request: Request, async_session: async_sessionmaker = Depends(get_session)
-) -> TweetsBand | None:
-    """Возвращает ленту твитов"""
-    username = request.headers.get("Api-Key")
+
+async def get_feed_json(
+    user_id: int,
+    limit: int,
+    cursor: str | None,
+    async_session: async_sessionmaker,
+) -> tuple[bytes, str | None]:
+    """Собирает страницу ленты из БД и возвращает ее JSON и курсор
+    следующей страницы. При JSON_SERIALIZER=postgres JSON твитов собирает
+    сама БД"""
+    push = config.TIMELINE_MODE == "push"
+
+    if config.JSON_SERIALIZER == "postgres":
+        page_query = timeline_page_query if push else feed_page_query
+        async with async_session() as session:
+            tweets, next_cursor = await get_feed_json_page(
+                session=session,
+                query=page_query(user_id=user_id, limit=limit, cursor=cursor),
+                limit=limit,
+            )
+        body = feed_page_envelope(tweets=tweets, next_cursor=next_cursor)
+        return body, next_cursor
 
     async with async_session() as session:
-        user = await get_user(username=username, session=session)
+        page = get_timeline_page if push else get_feed_page
+        all_tweets, next_cursor = await page(
+            session=session,
+            user_id=user_id,
+            limit=limit,
+            cursor=cursor,
+        )
+        likes = await get_likes(
+            tweet_ids=[tweet.id for tweet in all_tweets], session=session
+        )
 
-        if not user:
-            return None
+    body = feed_page_json(
+        tweets=all_tweets, likes=likes, next_cursor=next_cursor
+    )
+    return body, next_cursor
 
-        list_id_following_users = [json["id"] for json in user.following]
 
-        all_tw = await session.execute(
-            select(TweetsDB).order_by(
-                TweetsDB.user_id.in_(list_id_following_users).desc(),
-                func.cardinality(TweetsDB.likes).desc(),
-            )
+async def get_feed_followees(
+    user_id: int, limit: int, async_session: async_sessionmaker
+) -> list[int] | None:
+    """Авторы, при твитах которых сбрасывается страница ленты в кэше"""
+    async with async_session() as session:
+        return await get_followee_ids(
+            user_id=user_id, session=session, limit=limit
         )
-        all_tweets = all_tw.scalars().all()
-
-        tweet_band = TweetsBand(tweets=[])
-        for tweet in all_tweets:
-            tweet_for_band = TweetsForBand(
-                id=tweet.id,
-                content=tweet.tweet_data,
-                attachments=[
-                    "/api/medias/{id_media}".format(id_media=i)
-                    for i in tweet.tweet_media_ids
-                ],
-                author=Author(id=tweet.user_id, name=tweet.user.name),
-                likes=[Likes(**like_info) for like_info in tweet.likes],
-            )
-            tweet_band.tweets.append(tweet_for_band)
 
-    return tweet_band
+
+@app.get(
+    "/api/tweets",
+    response_model=TweetsBand | None,
+    response_model_exclude_none=True,
+)
+async def func_4(
+    request: Request,
+    user: UserIdentity | None = Depends(get_current_user),
+    limit: int = Query(default=FEED_PAGE_SIZE, ge=1, le=FEED_MAX_PAGE_SIZE),
+    cursor: str | None = None,
+    async_session: async_sessionmaker = Depends(get_session),
+    read_session: async_sessionmaker = Depends(get_read_session),
+) -> Response | None:
+    """Возвращает страницу ленты твитов, next_cursor указывает
+    на следующую страницу. Страница берется из кэша ленты, повторный
+    запрос с If-None-Match получает 304. Страницы для кэша собираются
+    на основной БД, с реплики - только если кэш выключен"""
+    if not user:
+        return None
+
+    page = await feed_cache.get_or_build(
+        user_id=user.id,
+        limit=limit,
+        cursor=cursor,
+        build=lambda cached: get_feed_json(
+            user_id=user.id,
+            limit=limit,
+            cursor=cursor,
+            async_session=async_session if cached else read_session,
+        ),
+        followees=lambda limit: get_feed_followees(
+            user_id=user.id, limit=limit, async_session=async_session
+        ),
+    )
+
+    headers = {"etag": page.etag, "cache-control": "private, no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), page.etag):
+        return Response(status_code=304, headers=headers)
+
+    return Response(
+        content=page.body, headers=headers, media_type="application/json"
+    )
+
+
+@app.get(
+    "/api/tweets/search",
+    response_model=TweetsBand,
+    response_model_exclude_none=True,
+)
+async def func_24(
+    q: str = Query(min_length=1, max_length=200),
+    limit: int = Query(default=FEED_PAGE_SIZE, ge=1, le=FEED_MAX_PAGE_SIZE),
+    cursor: str | None = None,
+    async_session: async_sessionmaker = Depends(get_read_session),
+) -> Response:
+    """Поиск твитов: q - слова (синтаксис websearch: "фраза", or,
+    -слово), результаты по релевантности, или один #хэштег или
+    @упоминание, результаты от новых к старым. next_cursor указывает
+    на следующую страницу"""
+    async with async_session() as session:
+        tweets, next_cursor = await search_tweets(
+            session=session, query=q, limit=limit, cursor=cursor
+        )
+        likes = await get_likes(
+            tweet_ids=[tweet.id for tweet in tweets], session=session
+        )
+
+    return Response(
+        content=feed_page_json(
+            tweets=tweets, likes=likes, next_cursor=next_cursor
+        ),
+        media_type="application/json",
+    )
 
 
 @app.post("/api/medias", status_code=201)
 async def func_5(
-    file: UploadFile, async_session: async_sessionmaker = Depends(get_session)
+    file: UploadFile,
+    background_tasks: BackgroundTasks,
+    async_session: async_sessionmaker = Depends(get_session),
 ) -> Medias | None:
-    """Сохраняет полученное изображение, добавляет в БД его название"""
-    filename: str | None = file.filename
-    if filename:
-        path = os.path.join("db", "images", filename)
-
-        while os.path.isfile(path):
-            fn = os.path.splitext(os.path.basename(path))[0]
-            add = f"{random.randint(0, 9)}"
-            path = path.replace(fn, fn + add)
-            filename = os.path.basename(path)
-
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        async with aiofiles.open(path, "wb") as out_file:
-            image = await file.read()
-            await out_file.write(image)
+    """Сохраняет полученное изображение потоком под именем из SHA-256
+    содержимого. Одинаковые изображения хранятся один раз, повторная
+    загрузка увеличивает счетчик ссылок и возвращает тот же id.
+    Уменьшенные копии создаются в фоне после ответа"""
+    stored = await save_upload(file)
 
     async with async_session() as session:
-        media = MediaDB(filename=os.path.basename(filename))
-
-        if not media:
-            return None
-
-        session.add(media)
+        media_id, filename = await add_media(stored=stored, session=session)
         await session.commit()
 
-    return Medias(media_id=media.id)
+    # у изображения, загруженного раньше, файл с другим именем,
+    # только что сохраненный файл не нужен
+    if filename != stored.filename:
+        background_tasks.add_task(
+            cleanup_media_files,
+            filenames=[stored.filename],
+            async_session=async_session,
+        )
+    background_tasks.add_task(
+        process_media,
+        media_id=media_id,
+        filename=filename,
+        async_session=async_session,
+    )
+    return Medias(media_id=media_id)
 
 
 @app.get("/api/medias/{id_media}", status_code=200)
 async def func_6(
-    id_media: int, async_session: async_sessionmaker = Depends(get_session)
+    id_media: int,
+    request: Request,
+    size: Literal["thumb", "medium"] | None = None,
+    async_session: async_sessionmaker = Depends(get_read_session),
 ) -> Response:
-    """Возвращает изображение по его id"""
+    """Возвращает изображение по его id, size - уменьшенная копия
+    (если ее нет, отдается оригинал). Файл отдается потоком
+    с поддержкой Range, повторный запрос с If-None-Match получает 304.
+    В режиме MEDIA_ACCEL_REDIRECT байты отдает nginx"""
     async with async_session() as session:
         file = await get_media(media_id=id_media, session=session)
 
         if not file:
-            return Response()
+            return Response(status_code=404)
 
         filename = file.filename
+        media_type = file.content_type or mimetypes.guess_type(filename)[0]
 
-    async with aiofiles.open(
-        os.path.join("db", "images", filename), "rb"
-    ) as out_file:
-        image = await out_file.read()
-
-    return Response(content=image)
+        variant = None
+        if size:
+            variant = await get_media_variant(
+                media_id=id_media, size=size, session=session
+            )
+        if variant:
+            filename, media_type = variant.filename, variant.content_type
+
+    path = os.path.join(config.MEDIA_ROOT, filename)
+    try:
+        stat_result = await aiofiles.os.stat(path)
+    except FileNotFoundError:
+        return Response(status_code=404)
+
+    headers = {
+        "etag": make_etag(
+            id_media,
+            file.sha256,
+            stat_result,
+            variant.size if variant else None,
+        ),
+        # пока уменьшенной копии нет, вместо нее отдается оригинал,
+        # такой ответ нельзя кэшировать надолго
+        "cache-control": (
+            CACHE_CONTROL if variant or not size else FALLBACK_CACHE_CONTROL
+        ),
+    }
+    if etag_matches(request.headers.get("if-none-match"), headers["etag"]):
+        return Response(status_code=304, headers=headers)
+
+    if config.MEDIA_ACCEL_REDIRECT:
+        headers["x-accel-redirect"] = config.MEDIA_ACCEL_PREFIX + filename
+        return Response(headers=headers, media_type=media_type)
+
+    return FileResponse(
+        path, headers=headers, media_type=media_type, stat_result=stat_result
+    )
 
 
 class TweetIndexError(Exception):
@@ -207,191 +596,442 @@ class TweetIndexError(Exception):
 
 @app.delete("/api/tweets/{tweet_id}", status_code=200)
 async def func_7(
-    request: Request,
     tweet_id: int,
+    background_tasks: BackgroundTasks,
+    user: UserIdentity | None = Depends(get_current_user),
     async_session: async_sessionmaker = Depends(get_session),
 ) -> Result | None:
-    """Удаляет твит из БД"""
-    async with async_session() as session:
-        username = request.headers.get("Api-Key")
-        user = await get_user(username=username, session=session)
+    """Удаляет твит из БД вместе с освободившимися изображениями,
+    файлы удаляются в фоне после ответа"""
+    if not user:
+        return None
 
-        if not user:
-            return None
+    async with async_session() as session:
+        filenames = await delete_tweet(
+            tweet_id=tweet_id, user_id=user.id, session=session
+        )
 
-        await session.refresh(user)
-
-        for tweet in user.tweets:
-            if tweet.id == tweet_id:
-                await session.execute(
-                    delete(TweetsDB).where(TweetsDB.id == tweet_id)
-                )
-                filenames = [
-                    await del_media(media_id, session=session)
-                    for media_id in tweet.tweet_media_ids
-                ]
-                for filename in filenames:
-                    if filename:
-                        path = os.path.join("db", "images", filename)
-                        os.remove(path)
-                break
-        else:
+        if filenames is None:
             raise TweetIndexError(name="У пользователя нет твита с таким id")
+
+        await outbox.record(
+            session,
+            events.TWEET_DELETED,
+            user_id=user.id,
+            tweet_ids=[tweet_id],
+        )
         await session.commit()
 
+    await events.emit(
+        events.TWEET_DELETED, user_id=user.id, tweet_ids=[tweet_id]
+    )
+
+    if filenames:
+        background_tasks.add_task(
+            cleanup_media_files,
+            filenames=filenames,
+            async_session=async_session,
+        )
     return Result()
 
 
 @app.post("/api/tweets/{tweet_id}/likes", status_code=201)
 async def func_8(
-    request: Request,
     tweet_id: int,
+    user: UserIdentity | None = Depends(get_current_user),
     async_session: async_sessionmaker = Depends(get_session),
 ) -> Result | None:
     """Добавляет лайк к твиту"""
-    username = request.headers.get("Api-Key")
+    if not user:
+        return None
 
+    buffered = config.COUNTERS_MODE == "buffered"
     async with async_session() as session:
-        user = await get_user(username=username, session=session)
-
-        if not user:
-            return None
-
-        tweet = await get_tweet(tweet_id=tweet_id, session=session)
-
-        if not tweet:
-            return None
-
-        tweet.likes.append({"user_id": user.id, "name": user.name})
-
-        await session.execute(
-            update(TweetsDB)
-            .where(TweetsDB.id == tweet_id)
-            .values(likes=tweet.likes)
+        added = await add_like(
+            tweet_id=tweet_id,
+            user_id=user.id,
+            session=session,
+            update_count=not buffered,
         )
+        if added:
+            await outbox.record(
+                session,
+                events.LIKE_ADDED,
+                user_id=user.id,
+                tweet_ids=[tweet_id],
+            )
         await session.commit()
 
+    if added and buffered:
+        counter_buffer.add([tweet_id], LIKES, 1)
+
+    await events.emit(events.LIKE_ADDED, user_id=user.id, tweet_ids=[tweet_id])
+
     return Result()
 
 
 @app.delete("/api/tweets/{tweet_id}/likes")
 async def func_9(
-    request: Request,
     tweet_id: int,
+    user: UserIdentity | None = Depends(get_current_user),
     async_session: async_sessionmaker = Depends(get_session),
 ) -> Result | None:
     """Удаляет лайк из твита"""
-    username = request.headers.get("Api-Key")
+    if not user:
+        return None
 
+    buffered = config.COUNTERS_MODE == "buffered"
     async with async_session() as session:
-        user = await get_user(username=username, session=session)
-
-        if not user:
-            return None
-
-        tweet = await get_tweet(tweet_id=tweet_id, session=session)
-
-        if not tweet:
-            return None
-
-        tweet.likes.remove({"user_id": user.id, "name": user.name})
-
-        await session.execute(
-            update(TweetsDB)
-            .where(TweetsDB.id == tweet_id)
-            .values(likes=tweet.likes)
+        removed = await remove_like(
+            tweet_id=tweet_id,
+            user_id=user.id,
+            session=session,
+            update_count=not buffered,
         )
+        if removed:
+            await outbox.record(
+                session,
+                events.LIKE_REMOVED,
+                user_id=user.id,
+                tweet_ids=[tweet_id],
+            )
         await session.commit()
 
+    if removed and buffered:
+        counter_buffer.add([tweet_id], LIKES, -1)
+
+    await events.emit(
+        events.LIKE_REMOVED, user_id=user.id, tweet_ids=[tweet_id]
+    )
+
     return Result()
 
 
 @app.post("/api/users/{user_id}/follow", status_code=201)
 async def func_10(
-    request: Request,
     user_id: int,
+    user: UserIdentity | None = Depends(get_current_user),
     async_session: async_sessionmaker = Depends(get_session),
 ) -> Result | None:
-    """Пользователь подписывается на другого(обновляется информация о
-    подписках в БД)
-    У пользователя на которого подписались, обновляется информация о
-    его подписчиках в БД
+    """Пользователь подписывается на другого(в таблицу follows
+    добавляется связь подписчик -> автор)
     """
-    username = request.headers.get("Api-Key")
+    if not user:
+        return None
 
     async with async_session() as session:
-        user_1 = await get_user(username=username, session=session)
-        user_2 = await get_user(user_id=user_id, session=session)
 
-        if not user_1 or not user_2:
-            return None
-
-        user_1.following.append(
-            Following(id=user_2.id, name=user_2.name).__dict__
-        )
-        await session.execute(
-            update(UsersDB)
-            .where(UsersDB.id == user_1.id)
-            .values(following=user_1.following)
+        followed = await follow(
+            follower_id=user.id, followee_id=user_id, session=session
         )
+        if followed:
+            await outbox.record(
+                session, events.FOLLOWED, user_id=user.id, followee_id=user_id
+            )
+        if followed and config.TIMELINE_MODE == "push":
+            await add_author_tweets(
+                user_id=user.id, author_id=user_id, session=session
+            )
+        await session.commit()
 
-        user_2.followers.append(
-            Followers(id=user_1.id, name=user_1.name).__dict__
+    if followed:
+        await events.emit(
+            events.FOLLOWED, user_id=user.id, followee_id=user_id
         )
-        await session.execute(
-            update(UsersDB)
-            .where(UsersDB.id == user_2.id)
-            .values(followers=user_2.followers)
-        )
-        await session.commit()
 
     return Result()
 
 
 @app.delete("/api/users/{user_id}/follow")
 async def func_11(
-    request: Request,
     user_id: int,
+    background_tasks: BackgroundTasks,
+    user: UserIdentity | None = Depends(get_current_user),
     async_session: async_sessionmaker = Depends(get_session),
 ) -> Result | None:
-    """Пользователь отписывается от другого(обновляется информация о
-    подписках в БД)
-    У пользователя от которого отписались, обновляется информация о
-    его подписчиках в БД
+    """Пользователь отписывается от другого(из таблицы follows
+    удаляется связь подписчик -> автор). Если твиты автора снова
+    раскладываются по лентам, написанные раньше раскладываются в фоне
     """
-    username = request.headers.get("Api-Key")
+    if not user:
+        return None
 
+    resumed = False
     async with async_session() as session:
-        user_1 = await get_user(username=username, session=session)
-        user_2 = await get_user(user_id=user_id, session=session)
 
-        if not user_1 or not user_2:
-            return None
+        unfollowed = await unfollow(
+            follower_id=user.id, followee_id=user_id, session=session
+        )
+        if unfollowed:
+            await outbox.record(
+                session,
+                events.UNFOLLOWED,
+                user_id=user.id,
+                followee_id=user_id,
+            )
+        if unfollowed and config.TIMELINE_MODE == "push":
+            await remove_author_tweets(
+                user_id=user.id, author_id=user_id, session=session
+            )
+            resumed = await fan_out_resumed(author_id=user_id, session=session)
+        await session.commit()
 
-        user_1.following.remove(
-            Following(id=user_2.id, name=user_2.name).__dict__
+    if resumed:
+        background_tasks.add_task(
+            backfill_author_tweets,
+            author_id=user_id,
+            async_session=async_session,
         )
-        await session.execute(
-            update(UsersDB)
-            .where(UsersDB.id == user_1.id)
-            .values(following=user_1.following)
+
+    if unfollowed:
+        await events.emit(
+            events.UNFOLLOWED, user_id=user.id, followee_id=user_id
         )
 
-        user_2.followers.remove(
-            Followers(id=user_1.id, name=user_1.name).__dict__
+    return Result()
+
+
+@app.post("/api/batch/users")
+async def func_17(
+    body: UserIds, async_session: async_sessionmaker = Depends(get_session)
+) -> UsersBatch:
+    """Возвращает нескольких пользователей по списку id, для каждого id
+    свой результат (result "false", если пользователя нет)"""
+    user_ids = list(dict.fromkeys(body.ids))
+
+    async with async_session() as session:
+        users_info = await get_users_info(user_ids=user_ids, session=session)
+
+    return respond(
+        UsersBatch,
+        users=[
+            (
+                {"result": "true", "id": user_id, "user": users_info[user_id]}
+                if user_id in users_info
+                else {"result": "false", "id": user_id, "user": None}
+            )
+            for user_id in user_ids
+        ],
+    )
+
+
+@app.post("/api/batch/tweets", status_code=201)
+async def func_18(
+    body: TweetsIn,
+    user: UserIdentity | None = Depends(get_current_user),
+    async_session: async_sessionmaker = Depends(get_session),
+) -> TweetsBatch | None:
+    """Добавляет несколько твитов одной транзакцией, id возвращаются
+    в порядке твитов в запросе"""
+    if not user:
+        return None
+
+    async with async_session() as session:
+        tweet_ids = await add_tweets(
+            tweets=body.tweets, user_id=user.id, session=session
+        )
+        await add_tweet_tags(
+            tweets={
+                tweet_id: tweet.tweet_data
+                for tweet_id, tweet in zip(tweet_ids, body.tweets)
+            },
+            session=session,
+        )
+        if config.TIMELINE_MODE == "push":
+            await fan_out_tweets(
+                tweet_ids=tweet_ids, author_id=user.id, session=session
+            )
+        await outbox.record(
+            session, events.TWEET_CREATED, user_id=user.id, tweet_ids=tweet_ids
+        )
+        await session.commit()
+
+    await events.emit(
+        events.TWEET_CREATED, user_id=user.id, tweet_ids=tweet_ids
+    )
+
+    return TweetsBatch(
+        tweets=[TweetOut(tweet_id=tweet_id) for tweet_id in tweet_ids]
+    )
+
+
+def likes_batch(tweet_ids: list[int], changed: dict[int, bool]) -> LikesBatch:
+    """Результат для каждого твита: result "false", если твита нет,
+    changed - изменился ли лайк этим запросом"""
+    return LikesBatch(
+        likes=[
+            (
+                LikeItem(tweet_id=tweet_id, changed=changed[tweet_id])
+                if tweet_id in changed
+                else LikeItem(tweet_id=tweet_id, result="false")
+            )
+            for tweet_id in tweet_ids
+        ]
+    )
+
+
+@app.post("/api/batch/likes")
+async def func_19(
+    body: TweetIds,
+    user: UserIdentity | None = Depends(get_current_user),
+    async_session: async_sessionmaker = Depends(get_session),
+) -> LikesBatch | None:
+    """Ставит лайки нескольким твитам одной транзакцией"""
+    if not user:
+        return None
+
+    tweet_ids = list(dict.fromkeys(body.tweet_ids))
+    buffered = config.COUNTERS_MODE == "buffered"
+    async with async_session() as session:
+        changed = await add_likes(
+            tweet_ids=tweet_ids,
+            user_id=user.id,
+            session=session,
+            update_count=not buffered,
         )
-        await session.execute(
-            update(UsersDB)
-            .where(UsersDB.id == user_2.id)
-            .values(followers=user_2.followers)
+        liked = [tweet_id for tweet_id, added in changed.items() if added]
+        if liked:
+            await outbox.record(
+                session, events.LIKE_ADDED, user_id=user.id, tweet_ids=liked
+            )
+        await session.commit()
+
+    if buffered:
+        counter_buffer.add(liked, LIKES, 1)
+    if liked:
+        await events.emit(events.LIKE_ADDED, user_id=user.id, tweet_ids=liked)
+
+    return likes_batch(tweet_ids=tweet_ids, changed=changed)
+
+
+@app.delete("/api/batch/likes")
+async def func_20(
+    body: TweetIds,
+    user: UserIdentity | None = Depends(get_current_user),
+    async_session: async_sessionmaker = Depends(get_session),
+) -> LikesBatch | None:
+    """Убирает лайки с нескольких твитов одной транзакцией"""
+    if not user:
+        return None
+
+    tweet_ids = list(dict.fromkeys(body.tweet_ids))
+    buffered = config.COUNTERS_MODE == "buffered"
+    async with async_session() as session:
+        changed = await remove_likes(
+            tweet_ids=tweet_ids,
+            user_id=user.id,
+            session=session,
+            update_count=not buffered,
         )
+        unliked = [
+            tweet_id for tweet_id, removed in changed.items() if removed
+        ]
+        if unliked:
+            await outbox.record(
+                session,
+                events.LIKE_REMOVED,
+                user_id=user.id,
+                tweet_ids=unliked,
+            )
         await session.commit()
 
+    if buffered:
+        counter_buffer.add(unliked, LIKES, -1)
+    if unliked:
+        await events.emit(
+            events.LIKE_REMOVED, user_id=user.id, tweet_ids=unliked
+        )
+
+    return likes_batch(tweet_ids=tweet_ids, changed=changed)
+
+
+@app.post("/api/batch/views")
+async def func_29(
+    body: TweetIds, user: UserIdentity | None = Depends(get_current_user)
+) -> Result | None:
+    """Отмечает просмотр твитов (твиты, показанные пользователю).
+    view_count обновляется в БД с задержкой, несуществующие твиты
+    пропускаются"""
+    if not user:
+        return None
+
+    counter_buffer.add(dict.fromkeys(body.tweet_ids), VIEWS, 1)
+    return Result()
+
+
+@app.get("/api/events/stream")
+async def func_30(
+    last_event_id: int | None = Header(default=None),
+    async_session: async_sessionmaker = Depends(get_session),
+) -> Response:
+    """Поток событий изменений (Server-Sent Events): tweet_created,
+    tweet_deleted, like_added, like_removed, followed, unfollowed.
+    После переподключения с Last-Event-ID сначала отдаются пропущенные
+    события. Если события не записываются (OUTBOX_ENABLED=false) - 404"""
+    if not config.OUTBOX_ENABLED:
+        return Response(status_code=404)
+
+    return StreamingResponse(
+        outbox.dispatcher.stream(
+            async_session=async_session, after_id=last_event_id
+        ),
+        media_type="text/event-stream",
+        headers={"cache-control": "no-cache", "x-accel-buffering": "no"},
+    )
+
+
+@app.get("/api/pool")
+async def func_15() -> PoolStatus:
+    """Возвращает состояние пула соединений с БД: занятые соединения,
+    overflow и время ожидания свободного соединения"""
+    return PoolStatus(**pool_status())
+
+
+@app.get("/metrics", include_in_schema=False)
+async def func_21() -> Response:
+    """Возвращает метрики запросов и состояние пула соединений
+    в текстовом формате Prometheus"""
+    gauges = {
+        f"db_pool_{name}": value for name, value in pool_status().items()
+    }
+    return Response(
+        content=metrics.render(gauges),
+        media_type="text/plain; version=0.0.4; charset=utf-8",
+    )
+
+
+@app.get("/health/live", include_in_schema=False)
+async def func_22() -> Result:
+    """Проверка, что процесс жив и обслуживает запросы, БД не проверяется"""
+    return Result()
+
+
+@app.get("/health/ready", include_in_schema=False)
+async def func_23(
+    async_session: async_sessionmaker = Depends(get_session),
+) -> Result:
+    """Проверка готовности принимать запросы: БД отвечает на SELECT 1
+    не дольше HEALTH_CHECK_TIMEOUT секунд, иначе 503"""
+    try:
+        async with async_session() as session:
+            await asyncio.wait_for(
+                session.execute(select(1)),
+                timeout=config.HEALTH_CHECK_TIMEOUT,
+            )
+    except (OSError, SQLAlchemyError, TimeoutError) as exc:
+        return JSONResponse(
+            status_code=503,
+            content={
+                "result": "false",
+                "error_type": "DatabaseUnavailable",
+                "error_message": str(exc) or type(exc).__name__,
+            },
+        )
     return Result()
 
 
 @app.exception_handler(TweetIndexError)
-def func_12(exc: TweetIndexError, *args, **kwargs) -> JSONResponse:
+def func_12(request: Request, exc: TweetIndexError) -> JSONResponse:
     """Возвращает тип и сообщение исключения TweetIndexError"""
     return JSONResponse(
         status_code=400,
@@ -403,8 +1043,34 @@ def func_12(exc: TweetIndexError, *args, **kwargs) -> JSONResponse:
     )
 
 
+@app.exception_handler(CursorError)
+def func_14(request: Request, exc: CursorError) -> JSONResponse:
+    """Возвращает тип и сообщение исключения CursorError"""
+    return JSONResponse(
+        status_code=400,
+        content={
+            "result": "false",
+            "error_type": exc.type,
+            "error_message": exc.name,
+        },
+    )
+
+
+@app.exception_handler(MediaTooLargeError)
+def func_16(request: Request, exc: MediaTooLargeError) -> JSONResponse:
+    """Возвращает тип и сообщение исключения MediaTooLargeError"""
+    return JSONResponse(
+        status_code=413,
+        content={
+            "result": "false",
+            "error_type": exc.type,
+            "error_message": exc.name,
+        },
+    )
+
+
 @app.exception_handler(Exception)
-def func_13(exc: Exception, *args, **kwargs) -> JSONResponse:
+def func_13(request: Request, exc: Exception) -> JSONResponse:
     """Возвращает тип и сообщение исключения"""
     return JSONResponse(
         status_code=400,
@@ -1,29 +1,17 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+
+from app.config import BATCH_MAX_SIZE
 
 
 class Result(BaseModel):
     result: str = "true"
 
 
-class Followers(BaseModel):
-    id: int
-    name: str
-
-
-class Following(BaseModel):
-    id: int
-    name: str
-
-
 class User(BaseModel):
     id: int
     name: str
-    followers: list[Followers]
-    following: list[Following]
-
-
-class UserOut(Result):
-    user: User
+    followers_count: int
+    following_count: int
 
 
 class TweetIn(BaseModel):
@@ -48,6 +36,15 @@ class Author(BaseModel):
     name: str
 
 
+class UserProfile(User):
+    followers: list[Author]
+    following: list[Author]
+
+
+class UserOut(Result):
+    user: UserProfile
+
+
 class Likes(BaseModel):
     user_id: int
     name: str
@@ -63,7 +60,68 @@ class TweetsForBand(BaseModel):
 
 class TweetsBand(Result):
     tweets: list[TweetsForBand]
+    next_cursor: str | None = None
 
 
 class Medias(Result):
     media_id: int
+
+
+class PoolStatus(Result):
+    size: int
+    checked_in: int
+    checked_out: int
+    overflow: int
+    max_overflow: int
+    waits: int
+    timeouts: int
+    wait_time_total: float
+    wait_time_max: float
+
+
+class UserIds(BaseModel):
+    ids: list[int] = Field(min_length=1, max_length=BATCH_MAX_SIZE)
+
+
+class UserItem(Result):
+    id: int
+    user: User | None = None
+
+
+class UsersBatch(Result):
+    users: list[UserItem]
+
+
+class TweetsIn(BaseModel):
+    tweets: list[TweetIn] = Field(min_length=1, max_length=BATCH_MAX_SIZE)
+
+
+class TweetsBatch(Result):
+    tweets: list[TweetOut]
+
+
+class TweetIds(BaseModel):
+    tweet_ids: list[int] = Field(min_length=1, max_length=BATCH_MAX_SIZE)
+
+
+class LikeItem(Result):
+    tweet_id: int
+    changed: bool = False
+
+
+class LikesBatch(Result):
+    likes: list[LikeItem]
+
+
+class FollowsPage(Result):
+    users: list[Author]
+    next_cursor: str | None = None
+
+
+class FollowItem(BaseModel):
+    id: int
+    following: bool
+
+
+class FollowsCheck(Result):
+    users: list[FollowItem]
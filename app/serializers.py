@@ -0,0 +1,94 @@
+"""Сериализация ответов горячих эндпоинтов (лента, списки пользователей).
+
+JSON_SERIALIZER=orjson - ответ собирается в обычные dict прямо из строк
+запроса и кодируется orjson, pydantic-модели не создаются и повторно
+не проверяются. JSON_SERIALIZER=pydantic - через модели routes_models.
+JSON_SERIALIZER=postgres - JSON твитов ленты собирает Postgres
+(functions.get_feed_json_page), остальное как в режиме orjson.
+Все режимы дают одинаковые байты, поэтому ETag ленты от режима
+не зависит.
+
+Сравнение режимов: python -m benchmarks.serialization
+"""
+
+import orjson
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import Row
+
+from app import config
+from app.media import media_url
+from app.routes_models import (
+    Result,
+    TweetsBand,
+    TweetsForBand,
+    Author,
+    Likes,
+)
+
+
+def feed_page_dict(
+    tweets: list[Row], likes: dict[int, list[dict]], next_cursor: str | None
+) -> dict:
+    """Страница ленты в форме TweetsBand (без next_cursor, если он None)"""
+    page = {
+        "result": "true",
+        "tweets": [
+            {
+                "id": tweet.id,
+                "content": tweet.tweet_data,
+                "attachments": [
+                    media_url(id_media=i) for i in tweet.tweet_media_ids
+                ],
+                "author": {"id": tweet.user_id, "name": tweet.author_name},
+                "likes": likes[tweet.id],
+            }
+            for tweet in tweets
+        ],
+    }
+    if next_cursor is not None:
+        page["next_cursor"] = next_cursor
+    return page
+
+
+def feed_page_model(
+    tweets: list[Row], likes: dict[int, list[dict]], next_cursor: str | None
+) -> TweetsBand:
+    """Страница ленты в виде pydantic-модели"""
+    tweet_band = TweetsBand(tweets=[], next_cursor=next_cursor)
+    for tweet in tweets:
+        tweet_for_band = TweetsForBand(
+            id=tweet.id,
+            content=tweet.tweet_data,
+            attachments=[media_url(id_media=i) for i in tweet.tweet_media_ids],
+            author=Author(id=tweet.user_id, name=tweet.author_name),
+            likes=[Likes(**like_info) for like_info in likes[tweet.id]],
+        )
+        tweet_band.tweets.append(tweet_for_band)
+    return tweet_band
+
+
+def feed_page_json(
+    tweets: list[Row], likes: dict[int, list[dict]], next_cursor: str | None
+) -> bytes:
+    """JSON страницы ленты"""
+    if config.JSON_SERIALIZER == "orjson":
+        return orjson.dumps(feed_page_dict(tweets, likes, next_cursor))
+
+    page = feed_page_model(tweets, likes, next_cursor)
+    return page.model_dump_json(exclude_none=True).encode()
+
+
+def feed_page_envelope(tweets: str, next_cursor: str | None) -> bytes:
+    """JSON страницы ленты из готового JSON твитов (содержимого массива)"""
+    body = b'{"result":"true","tweets":[' + tweets.encode() + b"]"
+    if next_cursor is not None:
+        body += b',"next_cursor":' + orjson.dumps(next_cursor)
+    return body + b"}"
+
+
+def respond(model: type[Result], **content) -> Result | ORJSONResponse:
+    """Ответ эндпоинта: content уже имеет форму model, в режиме pydantic
+    он проверяется моделью, иначе кодируется orjson как есть"""
+    if config.JSON_SERIALIZER != "pydantic":
+        return ORJSONResponse({"result": "true", **content})
+    return model(**content)
@@ -0,0 +1,388 @@
+"""Материализованные домашние ленты (fan-out on write).
+
+При публикации id твита раскладывается в таблицу timelines всем
+подписчикам автора, лента читается из нее страницами. Твиты авторов
+с числом подписчиков больше FANOUT_MAX_FOLLOWERS не раскладываются,
+а подмешиваются при чтении (fan-out on read).
+
+В ленте хранится не больше TIMELINE_MAX_LENGTH последних твитов,
+старые удаляются после каждого добавления. Когда у автора становится
+не больше FANOUT_MAX_FOLLOWERS подписчиков, его последние твиты
+раскладываются по лентам подписчиков в фоне (backfill_author_tweets).
+Твиты подписок старше TIMELINE_MAX_LENGTH последних остаются в ленте,
+но ранжируются вместе с твитами остальных авторов (is_followed=False),
+а не в начале ленты, как в режиме pull.
+
+Пересборка лент: python -m app.timeline
+"""
+
+import asyncio
+
+from sqlalchemy import (
+    Row,
+    Select,
+    select,
+    delete,
+    insert,
+    literal,
+    union,
+    func,
+    column,
+    true,
+    tuple_,
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert, ARRAY, INTEGER
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.orm import aliased
+
+from app.config import FANOUT_MAX_FOLLOWERS, TIMELINE_MAX_LENGTH
+from app.db_models import UsersDB, TweetsDB, FollowsDB, TimelinesDB
+from app.functions import (
+    decode_cursor,
+    make_page,
+    followees_query,
+    ranked_tweets_query,
+    merge_segments,
+)
+
+
+async def fan_out_tweet(
+    tweet_id: int, author_id: int, session: AsyncSession
+) -> None:
+    """Добавляет новый твит в ленты подписчиков автора, если у автора
+    не слишком много подписчиков"""
+    await fan_out_tweets(
+        tweet_ids=[tweet_id], author_id=author_id, session=session
+    )
+
+
+def fan_out_followers_query(author_id: int) -> Select:
+    """Подписчики автора, в ленты которых раскладываются его твиты"""
+    return (
+        select(FollowsDB.follower_id)
+        .join(UsersDB, UsersDB.id == FollowsDB.followee_id)
+        .where(
+            FollowsDB.followee_id == author_id,
+            UsersDB.followers_count <= FANOUT_MAX_FOLLOWERS,
+        )
+    )
+
+
+async def trim_timelines(
+    user_ids: Select | list[int], session: AsyncSession
+) -> None:
+    """Удаляет из лент пользователей твиты старше TIMELINE_MAX_LENGTH
+    последних. Граница находится по первичному ключу ленты, ленты
+    короче TIMELINE_MAX_LENGTH не изменяются"""
+    newest = aliased(TimelinesDB)
+    boundary = (
+        select(newest.tweet_id)
+        .where(newest.user_id == TimelinesDB.user_id)
+        .order_by(newest.tweet_id.desc())
+        .offset(TIMELINE_MAX_LENGTH - 1)
+        .limit(1)
+        .scalar_subquery()
+    )
+    await session.execute(
+        delete(TimelinesDB).where(
+            TimelinesDB.user_id.in_(user_ids),
+            TimelinesDB.tweet_id < boundary,
+        )
+    )
+
+
+async def fan_out_tweets(
+    tweet_ids: list[int], author_id: int, session: AsyncSession
+) -> None:
+    """Раскладывает несколько твитов автора по лентам подписчиков
+    одним запросом и обрезает их ленты"""
+    tweets = func.unnest(literal(tweet_ids, ARRAY(INTEGER))).alias("tweet_id")
+    followers = fan_out_followers_query(author_id).subquery()
+    await session.execute(
+        pg_insert(TimelinesDB)
+        .from_select(
+            ["user_id", "tweet_id"],
+            select(followers.c.follower_id, column("tweet_id", INTEGER))
+            .select_from(followers)
+            .join(tweets, true()),
+        )
+        .on_conflict_do_nothing()
+    )
+    await trim_timelines(fan_out_followers_query(author_id), session)
+
+
+async def add_author_tweets(
+    user_id: int, author_id: int, session: AsyncSession
+) -> None:
+    """После подписки добавляет в ленту пользователя последние твиты
+    автора"""
+    recent = (
+        select(literal(user_id), TweetsDB.id)
+        .join(UsersDB, UsersDB.id == TweetsDB.user_id)
+        .where(
+            TweetsDB.user_id == author_id,
+            UsersDB.followers_count <= FANOUT_MAX_FOLLOWERS,
+        )
+        .order_by(TweetsDB.id.desc())
+        .limit(TIMELINE_MAX_LENGTH)
+    )
+    await session.execute(
+        pg_insert(TimelinesDB)
+        .from_select(["user_id", "tweet_id"], recent)
+        .on_conflict_do_nothing()
+    )
+    await trim_timelines([user_id], session)
+
+
+async def fan_out_resumed(author_id: int, session: AsyncSession) -> bool:
+    """Проверяет после отписки, что у автора стало ровно
+    FANOUT_MAX_FOLLOWERS подписчиков: его твиты снова раскладываются
+    при публикации, а написанные раньше нужно разложить
+    (backfill_author_tweets)"""
+    followers_count = await session.scalar(
+        select(UsersDB.followers_count).where(UsersDB.id == author_id)
+    )
+    return followers_count == FANOUT_MAX_FOLLOWERS
+
+
+async def backfill_author_tweets(
+    author_id: int, async_session: async_sessionmaker, batch_size: int = 1000
+) -> None:
+    """Раскладывает последние твиты автора по лентам подписчиков
+    пачками по batch_size подписчиков, каждая пачка в своей транзакции.
+    Твиты, написанные, пока у автора было больше FANOUT_MAX_FOLLOWERS
+    подписчиков, есть только в его таблице твитов, а в ленту они
+    подмешиваются лишь для таких авторов"""
+    recent = (
+        select(TweetsDB.id)
+        .where(TweetsDB.user_id == author_id)
+        .order_by(TweetsDB.id.desc())
+        .limit(TIMELINE_MAX_LENGTH)
+        .subquery()
+    )
+    last_id = 0
+    while True:
+        async with async_session() as session:
+            follower_ids = (
+                await session.scalars(
+                    fan_out_followers_query(author_id)
+                    .where(FollowsDB.follower_id > last_id)
+                    .order_by(FollowsDB.follower_id)
+                    .limit(batch_size)
+                )
+            ).all()
+            if not follower_ids:
+                return
+
+            followers = func.unnest(
+                literal(follower_ids, ARRAY(INTEGER))
+            ).alias("follower_id")
+            await session.execute(
+                pg_insert(TimelinesDB)
+                .from_select(
+                    ["user_id", "tweet_id"],
+                    select(column("follower_id", INTEGER), recent.c.id)
+                    .select_from(followers)
+                    .join(recent, true()),
+                )
+                .on_conflict_do_nothing()
+            )
+            await trim_timelines(follower_ids, session)
+            await session.commit()
+
+        last_id = follower_ids[-1]
+
+
+async def remove_author_tweets(
+    user_id: int, author_id: int, session: AsyncSession
+) -> None:
+    """После отписки убирает твиты автора из ленты пользователя"""
+    await session.execute(
+        delete(TimelinesDB).where(
+            TimelinesDB.user_id == user_id,
+            TimelinesDB.tweet_id.in_(
+                select(TweetsDB.id).where(TweetsDB.user_id == author_id)
+            ),
+        )
+    )
+
+
+def timeline_tweets_query(user_id: int) -> Select:
+    """id твитов в ленте пользователя (не больше TIMELINE_MAX_LENGTH)"""
+    return select(TimelinesDB.tweet_id).where(TimelinesDB.user_id == user_id)
+
+
+def fan_out_on_read_authors_query(user_id: int) -> Select:
+    """Авторы подписок, твиты которых не раскладываются при публикации"""
+    return select(UsersDB.id).where(
+        UsersDB.id.in_(followees_query(user_id)),
+        UsersDB.followers_count > FANOUT_MAX_FOLLOWERS,
+    )
+
+
+def followed_tweets_query(
+    user_id: int, limit: int, keys: tuple[bool, int, int] | None
+) -> Select:
+    """Твиты подписок: из timelines и у авторов, которые
+    не раскладываются при публикации. У каждого такого автора берется
+    не больше limit твитов после ключа keys по индексу
+    ix_tweets_user_id_like_count_id, поэтому чтение не зависит от числа
+    его твитов"""
+    authors = fan_out_on_read_authors_query(user_id).subquery("authors")
+    author_tweet = aliased(TweetsDB)
+    author_tweets = (
+        select(author_tweet.id)
+        .where(author_tweet.user_id == authors.c.id)
+        .order_by(author_tweet.like_count.desc(), author_tweet.id.desc())
+        .limit(limit)
+    )
+    if keys:
+        author_tweets = author_tweets.where(
+            tuple_(author_tweet.like_count, author_tweet.id)
+            < tuple_(*keys[1:])
+        )
+    author_tweets = author_tweets.lateral("author_tweets")
+
+    candidates = union(
+        timeline_tweets_query(user_id),
+        select(author_tweets.c.id)
+        .select_from(authors)
+        .join(author_tweets, true()),
+    ).subquery()
+    return ranked_tweets_query(is_followed=True, limit=limit, keys=keys).join(
+        candidates, candidates.c.tweet_id == TweetsDB.id
+    )
+
+
+def other_tweets_query(
+    user_id: int, limit: int, keys: tuple[bool, int, int] | None
+) -> Select:
+    """Остальные твиты: все, кроме попавших в followed_tweets_query.
+    Твиты подписок, вытесненные из ленты (старше TIMELINE_MAX_LENGTH
+    последних), не пропадают, а идут здесь вместе с твитами
+    остальных авторов"""
+    return ranked_tweets_query(
+        is_followed=False, limit=limit, keys=keys
+    ).where(
+        TweetsDB.id.not_in(timeline_tweets_query(user_id)),
+        TweetsDB.user_id.not_in(fan_out_on_read_authors_query(user_id)),
+    )
+
+
+async def get_timeline_page(
+    session: AsyncSession,
+    user_id: int,
+    limit: int,
+    cursor: str | None = None,
+) -> tuple[list[Row], str | None]:
+    """Возвращает страницу ленты в том же порядке и с тем же курсором,
+    что и get_feed_page.
+
+    Твиты подписок берутся из timelines и у авторов, которые
+    не раскладываются при публикации, после них идут остальные твиты,
+    в том числе вытесненные из timelines твиты подписок"""
+    keys = decode_cursor(cursor) if cursor else None
+    rows = []
+
+    if keys is None or keys[0]:
+        query = followed_tweets_query(
+            user_id=user_id, limit=limit + 1, keys=keys
+        )
+        rows.extend((await session.execute(query)).all())
+
+    if len(rows) <= limit:
+        query = other_tweets_query(
+            user_id=user_id,
+            limit=limit + 1 - len(rows),
+            keys=keys if keys and not keys[0] else None,
+        )
+        rows.extend((await session.execute(query)).all())
+
+    return make_page(rows=rows, limit=limit)
+
+
+def timeline_page_query(
+    user_id: int, limit: int, cursor: str | None = None
+) -> Select:
+    """Страница ленты (limit + 1 строк) одним запросом, для сборки
+    JSON в Postgres"""
+    keys = decode_cursor(cursor) if cursor else None
+    segments = []
+    if keys is None or keys[0]:
+        segments.append(
+            followed_tweets_query(user_id=user_id, limit=limit + 1, keys=keys)
+        )
+    segments.append(
+        other_tweets_query(
+            user_id=user_id,
+            limit=limit + 1,
+            keys=keys if keys and not keys[0] else None,
+        )
+    )
+    return merge_segments(segments=segments, limit=limit)
+
+
+async def backfill_timelines(
+    async_session: async_sessionmaker, batch_size: int = 1000
+) -> int:
+    """Пересобирает ленты всех пользователей пачками по batch_size,
+    каждая пачка в своей транзакции. Возвращает число пользователей"""
+    last_id, total = 0, 0
+    while True:
+        async with async_session() as session:
+            user_ids = (
+                await session.scalars(
+                    select(UsersDB.id)
+                    .where(UsersDB.id > last_id)
+                    .order_by(UsersDB.id)
+                    .limit(batch_size)
+                )
+            ).all()
+            if not user_ids:
+                return total
+
+            ranked = (
+                select(
+                    FollowsDB.follower_id,
+                    TweetsDB.id,
+                    func.row_number()
+                    .over(
+                        partition_by=FollowsDB.follower_id,
+                        order_by=TweetsDB.id.desc(),
+                    )
+                    .label("position"),
+                )
+                .join(TweetsDB, TweetsDB.user_id == FollowsDB.followee_id)
+                .join(UsersDB, UsersDB.id == FollowsDB.followee_id)
+                .where(
+                    FollowsDB.follower_id.in_(user_ids),
+                    UsersDB.followers_count <= FANOUT_MAX_FOLLOWERS,
+                )
+                .subquery()
+            )
+            await session.execute(
+                delete(TimelinesDB).where(TimelinesDB.user_id.in_(user_ids))
+            )
+            await session.execute(
+                insert(TimelinesDB).from_select(
+                    ["user_id", "tweet_id"],
+                    select(ranked.c.follower_id, ranked.c.id).where(
+                        ranked.c.position <= TIMELINE_MAX_LENGTH
+                    ),
+                )
+            )
+            await session.commit()
+
+        last_id, total = user_ids[-1], total + len(user_ids)
+
+
+async def main() -> None:
+    from app.database import engine_async, async_session
+
+    total = await backfill_timelines(async_session)
+    await engine_async.dispose()
+    print(f"Пересобрано лент: {total}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
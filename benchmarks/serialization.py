@@ -0,0 +1,101 @@
+"""Сравнение сериализации страницы ленты.
+
+- fastapi - прежний путь: pydantic-объект на каждый твит и лайк, затем
+  FastAPI повторно проверяет результат моделью ответа и кодирует его
+  через jsonable_encoder и json.dumps;
+- pydantic - те же объекты, JSON строит model_dump_json;
+- orjson - dict из строк запроса, JSON строит orjson.
+
+Запуск из корня проекта: python -m benchmarks.serialization --tweets 2000
+"""
+
+import argparse
+import json
+import timeit
+from typing import NamedTuple
+
+from fastapi.encoders import jsonable_encoder
+
+from app import config
+from app.routes_models import TweetsBand
+from app.serializers import feed_page_json, feed_page_model
+
+
+class FeedRow(NamedTuple):
+    """Строка запроса ленты (колонки FEED_COLUMNS)"""
+
+    id: int
+    tweet_data: str
+    tweet_media_ids: list[int]
+    user_id: int
+    author_name: str
+
+
+def make_page(tweets: int, likes: int) -> tuple[list, dict]:
+    rows = [
+        FeedRow(
+            id=i,
+            tweet_data=f"Твит номер {i} " * 5,
+            tweet_media_ids=[i, i + 1],
+            user_id=i % 100,
+            author_name=f"user{i % 100:03}",
+        )
+        for i in range(tweets)
+    ]
+    tweet_likes = {
+        row.id: [{"user_id": j, "name": f"user{j:03}"} for j in range(likes)]
+        for row in rows
+    }
+    return rows, tweet_likes
+
+
+def fastapi_path(rows: list, likes: dict) -> bytes:
+    page = feed_page_model(rows, likes, "cursor")
+    validated = TweetsBand.model_validate(page.model_dump())
+    content = jsonable_encoder(validated, exclude_none=True)
+    return json.dumps(
+        content, ensure_ascii=False, separators=(",", ":")
+    ).encode()
+
+
+def serializer_path(serializer: str):
+    def run(rows: list, likes: dict) -> bytes:
+        config.JSON_SERIALIZER = serializer
+        return feed_page_json(rows, likes, "cursor")
+
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tweets", type=int, default=2000)
+    parser.add_argument("--likes", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    rows, likes = make_page(args.tweets, args.likes)
+    paths = {
+        "fastapi": fastapi_path,
+        "pydantic": serializer_path("pydantic"),
+        "orjson": serializer_path("orjson"),
+    }
+    bodies = {name: path(rows, likes) for name, path in paths.items()}
+    assert len(set(bodies.values())) == 1, "пути дают разный JSON"
+
+    print(f"{args.tweets} твитов, {args.likes} лайков на твит")
+    baseline = None
+    for name, path in paths.items():
+        seconds = min(
+            timeit.repeat(
+                lambda: path(rows, likes), number=1, repeat=args.repeat
+            )
+        )
+        baseline = baseline or seconds
+        print(
+            f"{name:>9}: {seconds * 1000:8.2f} мс на запрос,"
+            f" x{baseline / seconds:.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
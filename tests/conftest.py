@@ -2,12 +2,14 @@ import os
 
 import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import sessionmaker
 from starlette.routing import _DefaultLifespan
 
 from app.db_models import UsersDB, Base
+from app.feed_cache import feed_cache
+from app.functions import user_cache
 from app.routes import app, get_session
 
 docker_db = """
@@ -42,7 +44,27 @@ def client():
 @pytest.fixture
 def clear_db():
     Base.metadata.create_all(bind=engine_sync)
-    session.add(UsersDB(name="user001", followers=[], following=[]))
+    session.add(UsersDB(name="user001"))
     session.commit()
     yield
-    Base.metadata.drop_all(bind=engine_sync)
\ No newline at end of file
+    user_cache.clear()
+    feed_cache.backend.clear()
+    session.close()
+    Base.metadata.drop_all(bind=engine_sync)
+
+
+@pytest.fixture
+def queries():
+    """Собирает SQL-запросы, выполненные приложением во время теста"""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(
+        engine_async.sync_engine, "before_cursor_execute", before_cursor_execute
+    )
+    yield statements
+    event.remove(
+        engine_async.sync_engine, "before_cursor_execute", before_cursor_execute
+    )